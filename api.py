@@ -1,11 +1,145 @@
+import time
+import math
+import logging
+import threading
 from poloniex import Poloniex
 
-def getTicker(polo, pair=None):
-  ticker = polo.returnTicker()
+log = logging.getLogger('main')
+
+# Market order rates relative to the last price
+BUY_SLIPPAGE = 1.02
+SELL_SLIPPAGE = 0.8
+# Margin over the order book level when pricing from a local order book
+BOOK_MARGIN = 0.002
+# Market orders are limit orders whose unfilled rest is cancelled right away,
+# so nothing is left resting on the book after the fill is recorded
+MARKET_ORDER = 'immediateOrCancel'
+
+# Ticker snapshot shared by every caller, refreshed when older than tickerTtl seconds
+tickerTtl = 5
+tickerStats = {'hits':0, 'misses':0}
+_ticker = {'time':0.0, 'data':None}
+_tickerLock = threading.Lock()
+
+def setTickerTtl(ttl):
+  global tickerTtl
+  tickerTtl = ttl
+
+# The lock isn't held while fetching, a miss waiting in a low lane, e.g. a Telegram
+# command, must not hold up price checks. Misses at the same time share one response
+# through the scheduler, which moves it up to the highest lane waiting on it.
+def getTicker(polo, pair=None, fresh=False):
+  with _tickerLock:
+    now = time.monotonic()
+    miss = fresh or _ticker['data'] is None or now - _ticker['time'] >= tickerTtl
+    if miss:
+      tickerStats['misses'] += 1
+    else:
+      tickerStats['hits'] += 1
+      ticker = _ticker['data']
+  if miss:
+    ticker = polo.returnTicker()
+    with _tickerLock:
+      # A slower fetch started earlier doesn't replace a newer snapshot
+      if now >= _ticker['time']:
+        _ticker['data'] = ticker
+        _ticker['time'] = now
   if pair:
     return float(ticker[pair]['last'])
   return ticker
 
+# All balances from a single returnBalances call
+class Balances:
+  def __init__(self, polo):
+    self.balances = polo.returnBalances()
+
+  def __getitem__(self, currency):
+    return float(self.balances.get(currency, 0))
+
+# Coin and base amounts an order filled from its resultingTrades, net of fees
+def getFill(result):
+  coin = 0.0
+  base = 0.0
+  if not isinstance(result, dict):
+    return coin, base
+  for trade in result.get('resultingTrades', []):
+    amount = float(trade['amount'])
+    total = float(trade['total'])
+    if trade.get('type') == 'buy':
+      coin += float(trade.get('takerAdjustment', amount))
+      base += total
+    else:
+      coin += amount
+      base += float(trade.get('takerAdjustment', total))
+  return coin, base
+
+# Cancels the orders of an order response, in case any part of them still rests on
+# the book. Immediate or cancel orders are usually gone already, that error is expected.
+def cancelOrders(polo, result):
+  numbers = result.get('orderNumber') if isinstance(result, dict) else None
+  for number in numbers if isinstance(numbers, list) else [numbers]:
+    if not number:
+      continue
+    try:
+      polo.cancelOrder(number)
+      log.info(f'Cancelled order {number}')
+    except Exception as err:
+      log.debug(f'Order {number} not cancelled: {err!r}')
+
+def _truncate(amount):
+  return f'{math.floor(amount * 1e8) / 1e8:.8f}'
+
+def _merge(results):
+  merged = {'orderNumber':[], 'resultingTrades':[]}
+  for result in results:
+    if isinstance(result, dict):
+      merged['orderNumber'].append(result.get('orderNumber'))
+      merged['resultingTrades'].extend(result.get('resultingTrades', []))
+  return merged
+
+# Market order priced from the local order book, split where it walks the book too far.
+# Rates never go past the ticker slippage limits, None when the book can't fill the order.
+# A chunk that fails after others filled ends the order with the fills so far.
+def _bookOrder(polo, pair, side, book, amount=False, total=False):
+  if not book or not book.ready():
+    return None
+  chunks = book.split(side, amount=amount, total=total)
+  if not chunks:
+    return None
+  if side == 'buy':
+    limit = getTicker(polo, pair) * BUY_SLIPPAGE
+    place = polo.buy
+  else:
+    limit = getTicker(polo, pair) * SELL_SLIPPAGE
+    place = polo.sell
+  results = []
+  remaining = amount if amount else total
+  for n, (rate, chunkAmount) in enumerate(chunks):
+    if side == 'buy':
+      rate = min(rate * (1 + BOOK_MARGIN), limit)
+    else:
+      rate = max(rate * (1 - BOOK_MARGIN), limit)
+    last = n == len(chunks) - 1
+    if amount:
+      # Sells must not add up to more than the balance
+      chunkAmount = _truncate(remaining if last else min(chunkAmount, remaining))
+      remaining -= float(chunkAmount)
+    else:
+      # Buys by total are sized at the rate placed so they never reserve more than total
+      chunkTotal = remaining if last else min(chunkAmount * rate, remaining)
+      chunkAmount = _truncate(chunkTotal / rate)
+      remaining -= float(chunkAmount) * rate
+    if not float(chunkAmount):
+      continue
+    try:
+      results.append(place(pair, f'{rate:.8f}', chunkAmount, MARKET_ORDER))
+    except Exception as err:
+      if not results:
+        raise
+      log.warning(f'{pair} {side} chunk {n + 1} of {len(chunks)} failed: {err!r}, keeping the fills so far')
+      break
+  return _merge(results)
+
 def getAllBalances(polo, total=False):
   balances = polo.returnCompleteBalances()
   for currency in balances.copy():
@@ -25,33 +159,45 @@ def getTotalBalance(polo):
   total_USDT = total_BTC * USDT_BTC
   return float(f'{total_USDT:.8f}')
 
-def buy(polo, pair, rate=False, amount=False, market=False, total=False):
+def buy(polo, pair, rate=False, amount=False, market=False, total=False, book=None):
+  if market and book:
+    result = _bookOrder(polo, pair, 'buy', book, amount=float(amount) if amount else False, total=total)
+    if result:
+      return result
   if market and amount:
-    rate = getTicker(polo, pair) * 1.02
+    rate = getTicker(polo, pair) * BUY_SLIPPAGE
     rate = f'{rate:.8f}'
-    return polo.buy(pair, rate, amount)
+    return polo.buy(pair, rate, amount, MARKET_ORDER)
   if market and total:
     rate = getTicker(polo, pair)
-    rate *= 1.02
+    rate *= BUY_SLIPPAGE
     amount = total / rate
     amount = f'{amount:.8f}'
     rate = f'{rate:.8f}'
-    return polo.buy(pair, rate, amount)
+    return polo.buy(pair, rate, amount, MARKET_ORDER)
   if total and not market:
     amount = total / rate
     amount = f'{amount:.8f}'
     return polo.buy(pair, rate, amount)
   return 0
 
-def sell(polo, pair, rate=False, amount=False, market=False, all=False):
+def sell(polo, pair, rate=False, amount=False, market=False, all=False, balances=None, book=None):
   base, coin = pair.split('_')
+  if all:
+    balances = balances or Balances(polo)
+  if market and book:
+    result = _bookOrder(polo, pair, 'sell', book, amount=balances[coin] if all else float(amount))
+    if result:
+      return result
   if market and amount:
-    rate = getTicker(polo, pair) * 0.8
+    rate = getTicker(polo, pair) * SELL_SLIPPAGE
     rate = f'{rate:.8f}'
   if market and all:
-    amount = polo.returnBalances()[coin]
-    rate = getTicker(polo, pair) * 0.8
+    amount = f'{balances[coin]:.8f}'
+    rate = f'{getTicker(polo, pair) * SELL_SLIPPAGE:.8f}'
   if all and not market:
-    amount = polo.returnBalances()[coin]
+    amount = f'{balances[coin]:.8f}'
+  if market:
+    return polo.sell(pair, rate, amount, MARKET_ORDER)
   return polo.sell(pair, rate, amount)
   return 0
@@ -0,0 +1,103 @@
+import os
+import time
+import shutil
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+import candles
+from candles import Candle
+
+log = logging.getLogger('main')
+
+# Candles per returnChartData request
+CHUNK = 1000
+ATTEMPTS = 5
+
+# Chunk first and last candle dates, on a fixed grid so a rerun later resumes the same chunks
+def chunks(start, end, period):
+  step = period * CHUNK
+  return [(first, first + step - period) for first in range(start - start % step, end + 1, step)]
+
+def chunkPath(folder, first):
+  return os.path.join(folder, f'{first}.candles')
+
+# Sorted candles with one candle per date, the first chart given wins a date
+def merge(charts):
+  charts = [chart for chart in charts if len(chart)]
+  if not charts:
+    return candles.EMPTY
+  fields = {field:np.concatenate([getattr(chart, field) for chart in charts]) for field in Candle._fields}
+  dates, index = np.unique(fields['date'], return_index=True)
+  return candles.Chart(*(fields[field][index] for field in Candle._fields))
+
+# Fetches a chunk with backoff and writes it under its final name only when complete,
+# so an interrupted run leaves whole chunks behind
+def fetchChunk(polo, pair, period, first, last, path):
+  delay = 1
+  for attempt in range(ATTEMPTS):
+    try:
+      chart = candles.Chart.fromPoloniex(polo.returnChartData(pair, period, first, last))
+      break
+    except Exception as err:
+      if attempt == ATTEMPTS - 1:
+        raise
+      log.warning(f'{pair} {period} chunk {first} failed: {err!r}, retrying in {delay} seconds...')
+      time.sleep(delay)
+      delay *= 2
+  chart = chart[int(np.searchsorted(chart.date, first)):int(np.searchsorted(chart.date, last, side='right'))]
+  with open(path + '.tmp', 'wb') as f:
+    chart.records().tofile(f)
+  os.replace(path + '.tmp', path)
+  return len(chart)
+
+# A chunk left by an earlier run is complete when it reaches the last candle wanted now,
+# one cut short by the end of that run is fetched again
+def complete(path, last):
+  chart = candles.readCandles(path, 1)
+  return bool(len(chart)) and chart.date[-1] >= last
+
+# Downloads closed candles of every pair and period from start to end in chunks fetched
+# side by side, polo should be rate limited, e.g. by scheduler.install(). Chunks are kept in
+# data/backfill until all of a series are there, then merged with its candle file.
+# Returns candles, fetched chunks and failed chunks of each series.
+def backfill(polo, pairs, periods, start, end, workers=8, folder='data'):
+  series = {}
+  with ThreadPoolExecutor(workers, thread_name_prefix='backfill') as pool:
+    futures = {}
+    for pair in pairs:
+      for period in periods:
+        partial = os.path.join(folder, 'backfill', f'{pair}-{period}')
+        os.makedirs(partial, exist_ok=True)
+        # The forming candle is left to the trader
+        closed = end - end % period - period
+        parts = chunks(start, closed, period)
+        series[(pair, period)] = {'partial':partial, 'parts':parts, 'fetched':0, 'failed':0}
+        for first, last in parts:
+          path = chunkPath(partial, first)
+          if complete(path, min(last, closed)):
+            continue
+          futures[pool.submit(fetchChunk, polo, pair, period, first, min(last, closed), path)] = (pair, period, first)
+    for future in as_completed(futures):
+      pair, period, first = futures[future]
+      try:
+        future.result()
+        series[(pair, period)]['fetched'] += 1
+      except Exception as err:
+        log.error(f'{pair} {period} chunk {first} failed: {err!r}')
+        series[(pair, period)]['failed'] += 1
+  results = {}
+  for (pair, period), state in series.items():
+    results[(pair, period)] = {'candles':0, 'fetched':state['fetched'], 'failed':state['failed']}
+    if state['failed']:
+      continue
+    path = candles.storePath(pair, period, folder)
+    parts = [candles.readCandles(chunkPath(state['partial'], first)) for first, last in state['parts']]
+    chart = merge([candles.readCandles(path)] + parts)
+    with open(path + '.tmp', 'wb') as f:
+      chart.records().tofile(f)
+    os.replace(path + '.tmp', path)
+    shutil.rmtree(state['partial'])
+    results[(pair, period)]['candles'] = len(chart)
+  if not any(result['failed'] for result in results.values()):
+    shutil.rmtree(os.path.join(folder, 'backfill'), ignore_errors=True)
+  return results
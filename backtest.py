@@ -0,0 +1,134 @@
+import os
+import glob
+import multiprocessing
+import api
+import candles
+from candles import Candle
+from strategy import Strategy, MIN_BALANCE
+
+# Price path inside a candle: open, nearest extreme, other extreme, close
+def candleTicks(open, high, low, close):
+  if close >= open:
+    return (open, low, high, close)
+  return (open, high, low, close)
+
+# Plain python candles for the replay loop, independent of strategy settings
+def prepare(chart):
+  ha = candles.heikinAshi(chart)
+  ha = list(map(Candle, ha.date.tolist(), ha.open.tolist(), ha.high.tolist(),
+    ha.low.tolist(), ha.close.tolist(), ha.green.tolist()))
+  return ha, chart.open.tolist(), chart.high.tolist(), chart.low.tolist(), chart.close.tolist()
+
+def run(chart, pair='USDT_BTC', period=300, maxrisk=0.05, maxposition=False, balance=1000.0):
+  return simulate(prepare(chart), pair, period, maxrisk, maxposition, balance)
+
+def simulate(prepared, pair='USDT_BTC', period=300, maxrisk=0.05, maxposition=False, balance=1000.0):
+  strategy = Strategy(pair, maxrisk, maxposition)
+  ha, opens, highs, lows, closes = prepared
+  base = balance
+  coin = 0.0
+  cost = 0.0
+  trades = 0
+  wins = 0
+  peak = balance
+  drawdown = 0.0
+  for n in range(2, len(ha)):
+    # Ticks of the forming candle
+    for price in candleTicks(opens[n], highs[n], lows[n], closes[n]):
+      action = strategy.check(price)
+      if action == 'buy':
+        total = min(strategy.position_size, base)
+        coin += total / (price * api.BUY_SLIPPAGE)
+        base -= total
+        cost += total
+        strategy.opened()
+      elif action == 'sell':
+        value = coin * price * api.SELL_SLIPPAGE
+        base += value
+        coin = 0.0
+        trades += 1
+        if value > cost:
+          wins += 1
+        cost = 0.0
+        strategy.closed()
+      elif action == 'cancel':
+        strategy.cancel()
+    # Candle close
+    equity = base + coin * closes[n]
+    peak = max(peak, equity)
+    drawdown = max(drawdown, 1 - equity / peak)
+    signal = strategy.signal(ha[n], ha[n-1])
+    if signal == 'buy':
+      if base > MIN_BALANCE:
+        strategy.setup(ha[n], equity, base)
+    elif signal == 'pullback':
+      if strategy.position_open:
+        strategy.moveStop(ha[n])
+    elif signal == 'red':
+      strategy.moveStop(ha[n])
+  equity = base + coin * closes[-1] if closes else balance
+  return {
+      'pair':pair,
+      'period':period,
+      'maxrisk':maxrisk,
+      'maxposition':maxposition,
+      'candles':len(ha),
+      'trades':trades,
+      'wins':wins,
+      'pnl':equity - balance,
+      'pnl_persent':(equity / balance - 1) * 100,
+      'drawdown_persent':drawdown * 100
+      }
+
+def runFile(path, pair='USDT_BTC', period=300, maxrisk=0.05, maxposition=False, balance=1000.0):
+  name = candles.parseStorePath(path)
+  if name:
+    pair, period = name
+  chart = candles.readCandles(path)
+  return run(chart, pair, period, maxrisk, maxposition, balance)
+
+# Prepared candles of the file a sweep worker is on, jobs come chunked per file
+# so only the last one is kept
+_prepared = {'path':None, 'candles':None}
+
+def _sweepJob(job):
+  path, maxrisk, maxposition, balance = job
+  if _prepared['path'] != path:
+    _prepared['candles'] = None
+    _prepared['candles'] = prepare(candles.mapCandles(path))
+    _prepared['path'] = path
+  pair, period = candles.parseStorePath(path)
+  return simulate(_prepared['candles'], pair, period, maxrisk, maxposition, balance)
+
+def sweep(pattern, maxrisks, maxpositions, balance=1000.0, workers=None):
+  paths = sorted(path for path in glob.glob(pattern) if candles.parseStorePath(path))
+  jobs = [(path, maxrisk, maxposition, balance)
+    for path in paths for maxrisk in maxrisks for maxposition in maxpositions]
+  if not jobs:
+    return []
+  workers = workers or os.cpu_count()
+  # Jobs of one file go to the same worker so it maps and prepares the file once
+  chunksize = max(1, min(len(maxrisks) * len(maxpositions), len(jobs) // workers))
+  with multiprocessing.Pool(workers) as pool:
+    reports = list(pool.imap_unordered(_sweepJob, jobs, chunksize))
+  reports.sort(key=lambda report: report['pnl_persent'], reverse=True)
+  return reports
+
+def formatTable(reports):
+  lines = [f'{"#":>4} {"pair":<12} {"period":>6} {"risk%":>6} {"maxpos":>10} {"trades":>6} {"wins":>5} {"pnl%":>9} {"dd%":>7}']
+  for n, report in enumerate(reports, 1):
+    lines.append(
+        f'{n:>4} {report["pair"]:<12} {report["period"]:>6} {report["maxrisk"]*100:>6.2f} '
+        f'{report["maxposition"] or "-":>10} {report["trades"]:>6} {report["wins"]:>5} '
+        f'{report["pnl_persent"]:>9.2f} {report["drawdown_persent"]:>7.2f}')
+  return '\n'.join(lines)
+
+def formatReport(report):
+  base = report['pair'].split('_')[0]
+  return f'''Backtest {report['pair']}-{report['period']}
+Candles: {report['candles']}
+Max risk: {report['maxrisk']*100}%
+Max position size: {report['maxposition']}
+Trades: {report['trades']}, wins: {report['wins']}
+PnL: {report['pnl']:.8f} {base}, {report['pnl_persent']:.2f}%
+Max drawdown: {report['drawdown_persent']:.2f}%'''
@@ -0,0 +1,309 @@
+import os
+import sys
+import json
+import time
+import getopt
+import platform
+import statistics
+import asyncio
+import tempfile
+import numpy as np
+import api
+import main
+import candles
+import backtest
+from strategy import Strategy
+
+# Synthetic random walk candles, the same seed always gives the same chart
+def syntheticChart(count, period=300, start=1500000000, price=100.0, seed=0):
+  random = np.random.RandomState(seed)
+  close = price * np.exp(np.cumsum(random.normal(0, 0.004, count)))
+  open = np.concatenate(([price], close[:-1]))
+  high = np.maximum(open, close) * (1 + np.abs(random.normal(0, 0.002, count)))
+  low = np.minimum(open, close) * (1 - np.abs(random.normal(0, 0.002, count)))
+  date = start + period * np.arange(count, dtype=np.int64)
+  return candles.Chart(date, np.round(open, 8), np.round(high, 8), np.round(low, 8), np.round(close, 8))
+
+# returnChartData response for a chart
+def poloniexCandles(chart):
+  return [{
+      'date':date,
+      'high':high,
+      'low':low,
+      'open':open,
+      'close':close,
+      'volume':0,
+      'quoteVolume':0,
+      'weightedAverage':close
+      } for date, open, high, low, close in zip(chart.date.tolist(), chart.open.tolist(),
+        chart.high.tolist(), chart.low.tolist(), chart.close.tolist())]
+
+# In process Poloniex with the same call signatures as the client.
+# Serves candles of the charts passed in up to the current time set with
+# setTime(), prices are the close of the forming candle and orders fill
+# right away at their rate.
+class FakePoloniex:
+  def __init__(self, charts, balances=None, fee=0.0025):
+    self.charts = charts
+    self.balances = balances or {'USDT':1000.0}
+    self.fee = fee
+    self.now = max(int(chart.date[-1]) for chart in charts.values())
+    self.orders = 0
+    self.calls = {}
+
+  def setTime(self, now):
+    self.now = now
+
+  def called(self, name):
+    self.calls[name] = self.calls.get(name, 0) + 1
+
+  def chart(self, pair):
+    for (chartPair, period), chart in self.charts.items():
+      if chartPair == pair:
+        return chart
+    raise KeyError(pair)
+
+  def price(self, pair):
+    chart = self.chart(pair)
+    n = max(0, int(np.searchsorted(chart.date, self.now, side='right')) - 1)
+    return float(chart.close[n])
+
+  def returnTicker(self):
+    self.called('returnTicker')
+    pairs = sorted({pair for pair, period in self.charts})
+    return {pair:{'id':n, 'last':f'{self.price(pair):.8f}'} for n, pair in enumerate(pairs)}
+
+  def returnChartData(self, currencyPair, period=False, start=False, end=False):
+    self.called('returnChartData')
+    chart = self.charts[(currencyPair, period)]
+    first = int(np.searchsorted(chart.date, start))
+    last = int(np.searchsorted(chart.date, min(end, self.now), side='right'))
+    return poloniexCandles(chart[first:last])
+
+  def returnBalances(self):
+    self.called('returnBalances')
+    return {currency:f'{amount:.8f}' for currency, amount in self.balances.items()}
+
+  def returnCompleteBalances(self):
+    self.called('returnCompleteBalances')
+    btcPrice = self.price('USDT_BTC') if any(pair == 'USDT_BTC' for pair, period in self.charts) else 1.0
+    complete = {}
+    for currency, amount in self.balances.items():
+      if currency == 'BTC':
+        btcValue = amount
+      elif currency == 'USDT':
+        btcValue = amount / btcPrice
+      else:
+        btcValue = amount * self.price(f'USDT_{currency}') / btcPrice
+      complete[currency] = {'available':f'{amount:.8f}', 'onOrders':'0.00000000', 'btcValue':f'{btcValue:.8f}'}
+    return complete
+
+  def order(self, side, pair, rate, amount):
+    base, coin = pair.split('_')
+    rate = float(rate)
+    amount = float(amount)
+    total = rate * amount
+    self.orders += 1
+    trade = {'amount':f'{amount:.8f}', 'rate':f'{rate:.8f}', 'total':f'{total:.8f}', 'type':side}
+    if side == 'buy':
+      self.balances[base] = self.balances.get(base, 0.0) - total
+      self.balances[coin] = self.balances.get(coin, 0.0) + amount * (1 - self.fee)
+      trade['takerAdjustment'] = f'{amount * (1 - self.fee):.8f}'
+    else:
+      self.balances[coin] = self.balances.get(coin, 0.0) - amount
+      self.balances[base] = self.balances.get(base, 0.0) + total * (1 - self.fee)
+      trade['takerAdjustment'] = f'{total * (1 - self.fee):.8f}'
+    return {'orderNumber':str(self.orders), 'resultingTrades':[trade]}
+
+  def buy(self, currencyPair, rate, amount, orderType=False):
+    self.called('buy')
+    return self.order('buy', currencyPair, rate, amount)
+
+  def sell(self, currencyPair, rate, amount, orderType=False):
+    self.called('sell')
+    return self.order('sell', currencyPair, rate, amount)
+
+# Runs fn repeat times, setup output is passed to fn and not timed
+def measure(name, size, items, fn, setup=None, repeat=3):
+  times = []
+  for n in range(repeat):
+    state = setup() if setup else None
+    start = time.perf_counter()
+    fn(state)
+    times.append(time.perf_counter() - start)
+  return {
+      'name':name,
+      'size':size,
+      'repeat':repeat,
+      'best':min(times),
+      'median':statistics.median(times),
+      'mean':statistics.mean(times),
+      'per_item':min(times) / items
+      }
+
+# Converting returnChartData responses to a chart, in 1000 candle windows like the store fetches them
+def benchConversion(size, repeat):
+  window = 1000
+  chart = syntheticChart(size)
+  responses = [poloniexCandles(chart[n:n + window]) for n in range(0, min(size, 100 * window), window)]
+  rounds = -(-size // window)
+  def convert(state):
+    for n in range(rounds):
+      candles.Chart.fromPoloniex(responses[n % len(responses)])
+  return measure('conversion', size, size, convert, repeat=repeat)
+
+def benchHeikinAshi(size, repeat):
+  chart = syntheticChart(size)
+  return measure('heikin_ashi', size, size, lambda state: candles.heikinAshi(chart), repeat=repeat)
+
+# Candle close handling of main.Trader, the close built from ticks of the forming candle,
+# or fetched from the exchange when there were none, then the strategy decision
+def benchCandleClose(size, repeat, closes=20, fetch=False):
+  period = 300
+  chart = syntheticChart(size + closes * repeat + 1, period)
+  folder = tempfile.mkdtemp(prefix='benchmark-')
+  candles.appendCandles(candles.storePath('USDT_BTC', period, folder), chart[:size - 1])
+  polo = FakePoloniex({('USDT_BTC', period):chart})
+  polo.setTime(int(chart.date[size - 1]))
+  main.polo = polo
+  main.private_api = True
+  trader = main.Trader('USDT_BTC', period)
+  trader.strategy.statePath = None
+  trader.store = candles.CandleStore('USDT_BTC', period, window=size, folder=folder)
+  trader.store.update(polo, polo.now)
+  trader.chart = trader.store.heikinAshi
+  async def close():
+    for n in range(closes):
+      forming = int(trader.store.candles.date[-1])
+      if not fetch:
+        row = (forming - int(chart.date[0])) // period
+        ticks = backtest.candleTicks(chart.open[row], chart.high[row], chart.low[row], chart.close[row])
+        for offset, price in enumerate(ticks, 1):
+          trader.onPrice(float(price), forming + offset)
+      polo.setTime(forming + period)
+      await trader.onCandle(forming + period)
+  try:
+    return measure('candle_fetch' if fetch else 'candle_close', size, closes, lambda state: asyncio.run(close()), repeat=repeat)
+  finally:
+    for name in os.listdir(folder):
+      os.remove(os.path.join(folder, name))
+    os.rmdir(folder)
+
+def benchCandleFetch(size, repeat):
+  return benchCandleClose(size, repeat, fetch=True)
+
+# One tick of the polling loop: a single ticker request, then an entry or stop check per pair
+def benchTick(pairs, repeat, ticks=1000):
+  charts = {(f'USDT_C{n}', 300):syntheticChart(10, seed=n) for n in range(pairs)}
+  polo = FakePoloniex(charts)
+  strategies = []
+  for pair, period in charts:
+    strategy = Strategy(pair, 0.05)
+    strategy.position_entry = polo.price(pair) * 2
+    strategy.position_size = 100
+    strategies.append(strategy)
+  def tick(state):
+    for n in range(ticks):
+      ticker = api.getTicker(polo, fresh=True)
+      for strategy in strategies:
+        strategy.check(float(ticker[strategy.pair]['last']))
+  return measure('tick', pairs, ticks, tick, repeat=repeat)
+
+# Full strategy replay, the decision path over the whole history
+def benchBacktest(size, repeat):
+  chart = syntheticChart(size)
+  return measure('backtest', size, size, lambda state: backtest.run(chart), repeat=repeat)
+
+BENCHMARKS = {
+    'conversion':benchConversion,
+    'heikin_ashi':benchHeikinAshi,
+    'candle_close':benchCandleClose,
+    'candle_fetch':benchCandleFetch,
+    'backtest':benchBacktest
+    }
+
+def runAll(sizes, pairCounts, names=None, repeat=3, report=None):
+  results = []
+  for name, bench in BENCHMARKS.items():
+    if names and name not in names:
+      continue
+    for size in sizes:
+      results.append(bench(size, repeat))
+      if report:
+        report(results[-1])
+  if not names or 'tick' in names:
+    for pairs in pairCounts:
+      results.append(benchTick(pairs, repeat))
+      if report:
+        report(results[-1])
+  return {
+      'python':platform.python_version(),
+      'numpy':np.__version__,
+      'machine':platform.machine(),
+      'time':int(time.time()),
+      'results':results
+      }
+
+def formatResult(result):
+  return (f'{result["name"]:<14} {result["size"]:>9} {result["best"]:>11.6f} '
+    f'{result["median"]:>11.6f} {result["per_item"] * 1e6:>12.3f}')
+
+# Change of the best time against an earlier run, positive is slower
+def compare(old, new):
+  before = {(result['name'], result['size']):result['best'] for result in old['results']}
+  lines = []
+  for result in new['results']:
+    key = (result['name'], result['size'])
+    if key in before and before[key]:
+      change = (result['best'] / before[key] - 1) * 100
+      lines.append(f'{result["name"]:<14} {result["size"]:>9} {change:>+8.1f}%')
+  return '\n'.join(lines)
+
+if __name__ == '__main__':
+  sizes = [1000, 100000, 1000000]
+  pairCounts = [1, 10, 100]
+  names = None
+  repeat = 3
+  output = False
+  baseline = False
+  try:
+    args, values = getopt.getopt(sys.argv[1:], 'h', ['help', 'sizes=', 'pairs=', 'only=', 'repeat=', 'output=', 'compare='])
+    for arg, value in args:
+      if arg in ('-h', '--help'):
+        print(
+'''
+Arguments:
+--sizes <counts> - comma separated candle counts, default: 1000,100000,1000000
+--pairs <counts> - comma separated pair counts for the tick benchmark, default: 1,10,100
+--only <names> - comma separated benchmarks to run: conversion, heikin_ashi, candle_close, candle_fetch, backtest, tick
+--repeat <number> - runs of each benchmark, the best is reported, default: 3
+--output <file> - write results as json
+--compare <file> - json results of an earlier run to compare with
+'''
+            )
+        sys.exit(0)
+      elif arg in ('--sizes'):
+        sizes = [int(size) for size in value.split(',')]
+      elif arg in ('--pairs'):
+        pairCounts = [int(pairs) for pairs in value.split(',')]
+      elif arg in ('--only'):
+        names = value.split(',')
+      elif arg in ('--repeat'):
+        repeat = int(value)
+      elif arg in ('--output'):
+        output = value
+      elif arg in ('--compare'):
+        baseline = value
+  except getopt.error as err:
+    print(str(err))
+    sys.exit(1)
+
+  api.setTickerTtl(0)
+  print(f'{"benchmark":<14} {"size":>9} {"best s":>11} {"median s":>11} {"per item us":>12}')
+  run = runAll(sizes, pairCounts, names, repeat, lambda result: print(formatResult(result), flush=True))
+  if output:
+    with open(output, 'w') as f:
+      json.dump(run, f, indent=2)
+  if baseline:
+    with open(baseline) as f:
+      print(compare(json.load(f), run))
@@ -0,0 +1,400 @@
+import os
+import logging
+import threading
+from collections import namedtuple
+import numpy as np
+import metrics
+
+log = logging.getLogger('main')
+
+# On disk candle record: date, open, high, low, close
+RECORD = np.dtype([
+  ('date', '<i8'),
+  ('open', '<f8'),
+  ('high', '<f8'),
+  ('low', '<f8'),
+  ('close', '<f8')
+  ])
+
+class Candle(namedtuple('Candle', 'date open high low close green')):
+  __slots__ = ()
+
+  @property
+  def color(self):
+    return 'green' if self.green else 'red'
+
+# Columnar chart, aligned arrays with one row per candle
+class Chart:
+  def __init__(self, date, open, high, low, close, green=None):
+    self.date = np.asarray(date, dtype=np.int64)
+    self.open = np.asarray(open, dtype=np.float64)
+    self.high = np.asarray(high, dtype=np.float64)
+    self.low = np.asarray(low, dtype=np.float64)
+    self.close = np.asarray(close, dtype=np.float64)
+    if green is None:
+      green = self.open <= self.close
+    self.green = np.asarray(green, dtype=bool)
+
+  @classmethod
+  def fromRecords(cls, records):
+    return cls(records['date'], records['open'], records['high'], records['low'], records['close'])
+
+  @classmethod
+  def fromPoloniex(cls, data):
+    # Poloniex returns a single zero candle when there is no data
+    data = [candle for candle in data if int(candle['date']) != 0]
+    return cls(
+        [int(candle['date']) for candle in data],
+        [float(candle['open']) for candle in data],
+        [float(candle['high']) for candle in data],
+        [float(candle['low']) for candle in data],
+        [float(candle['close']) for candle in data]
+        )
+
+  def records(self):
+    records = np.empty(len(self), dtype=RECORD)
+    for field in RECORD.names:
+      records[field] = getattr(self, field)
+    return records
+
+  def append(self, other):
+    return Chart(*(np.concatenate((getattr(self, field), getattr(other, field)))
+      for field in Candle._fields))
+
+  def __len__(self):
+    return len(self.date)
+
+  def __getitem__(self, key):
+    if isinstance(key, slice):
+      return Chart(*(getattr(self, field)[key] for field in Candle._fields))
+    return Candle(
+        int(self.date[key]),
+        float(self.open[key]),
+        float(self.high[key]),
+        float(self.low[key]),
+        float(self.close[key]),
+        bool(self.green[key])
+        )
+
+  def __iter__(self):
+    for n in range(len(self)):
+      yield self[n]
+
+EMPTY = Chart([], [], [], [], [])
+
+# HA values are rounded to 8 decimals with python's correctly rounded round(),
+# np.round scales by 1e8 and is off by 1e-8 for some values
+_midpoint = np.frompyfunc(lambda a, b: round((a + b) / 2, 8), 2, 1)
+_round8 = np.frompyfunc(lambda x: round(x, 8), 1, 1)
+
+def heikinAshi(chart, prev=None):
+  if not len(chart):
+    return EMPTY
+  if prev is None:
+    prev = chart[0]
+  close = _round8((chart.open + chart.high + chart.low + chart.close) / 4).astype(np.float64)
+  scan = np.empty(len(chart), dtype=object)
+  scan[0] = round((prev.open + prev.close) / 2, 8)
+  scan[1:] = close[:-1]
+  open = _midpoint.accumulate(scan, dtype=object).astype(np.float64)
+  high = np.maximum.reduce((chart.high, chart.low, open, close))
+  low = np.minimum.reduce((chart.high, chart.low, open, close))
+  return Chart(chart.date, open, high, low, close)
+
+def storePath(pair, period, folder='data'):
+  return os.path.join(folder, f'{pair}-{period}.candles')
+
+def parseStorePath(path):
+  name = os.path.basename(path)
+  if not name.endswith('.candles'):
+    return None
+  pair, _, period = name[:-len('.candles')].rpartition('-')
+  if not pair or not period.isdigit():
+    return None
+  return pair, int(period)
+
+def readCandles(path, count=None):
+  try:
+    size = os.path.getsize(path) // RECORD.itemsize
+  except FileNotFoundError:
+    return EMPTY
+  offset = max(0, size - count) if count else 0
+  records = np.fromfile(path, dtype=RECORD, offset=offset * RECORD.itemsize, count=size - offset)
+  return Chart.fromRecords(records)
+
+# Read only zero copy view of a candle file, shared between processes by the page cache
+def mapCandles(path):
+  size = os.path.getsize(path) // RECORD.itemsize
+  if not size:
+    return EMPTY
+  return Chart.fromRecords(np.memmap(path, dtype=RECORD, mode='r', shape=(size,)))
+
+def appendCandles(path, chart):
+  folder = os.path.dirname(path)
+  if folder:
+    os.makedirs(folder, exist_ok=True)
+  with open(path, 'ab') as f:
+    chart.records().tofile(f)
+
+# Candle history of one pair and period, persisted to disk.
+# Only closed candles confirmed by the exchange are written, the last candle in memory is the forming one.
+# Price ticks build the forming candle so a close is known as soon as its period ends,
+# exchange candles fetched later replace the ones built from ticks.
+# Updates ask Poloniex for candles starting at the first unconfirmed candle
+# and extend Heikin Ashi with the new candles only.
+class CandleStore:
+  def __init__(self, pair, period, window=1000, folder='data'):
+    self.pair = pair
+    self.period = period
+    self.window = window
+    self.path = storePath(pair, period, folder)
+    self.candles = readCandles(self.path, window)
+    self.savedDate = int(self.candles.date[-1]) if len(self.candles) else 0
+    self.heikinAshi = heikinAshi(self.candles)
+    # Date of the first closed candle not confirmed by the exchange yet
+    self.pending = None
+    # The forming candle got a tick since it started
+    self.ticked = False
+    self.opening = False
+    # Fetched from the exchange since loading, the forming candle read from disk is stale until then
+    self.updated = False
+    self.lock = threading.Lock()
+    # One exchange fetch at a time, stores resampled from this one update it too
+    self.updating = threading.Lock()
+    log.debug(f'Loaded {len(self.candles)} {pair} {period} candles from {self.path}')
+
+  # Last price into the forming candle, a tick past its period closes it first
+  def tick(self, price, now):
+    with self.lock:
+      if not len(self.candles):
+        return
+      if now >= self.candles.date[-1] + self.period and not self.roll(now):
+        return
+      candles = self.candles
+      # The first trade of a candle opened by roll() is its open
+      if self.opening:
+        candles.open[-1] = candles.high[-1] = candles.low[-1] = price
+        self.opening = False
+      candles.high[-1] = max(candles.high[-1], price)
+      candles.low[-1] = min(candles.low[-1], price)
+      candles.close[-1] = price
+      candles.green[-1] = candles.open[-1] <= price
+      self.ticked = True
+
+  # Closes the forming candle and opens the next one at its close until the first tick,
+  # only when ticks covered it and at most one period has passed
+  def roll(self, now):
+    date = int(self.candles.date[-1])
+    if not self.ticked or now >= date + 2 * self.period:
+      return False
+    price = float(self.candles.close[-1])
+    forming = Chart([date + self.period], [price], [price], [price], [price])
+    closed = heikinAshi(self.candles[-1:], self.heikinAshi[-2] if len(self.heikinAshi) > 1 else None)
+    self.heikinAshi = self.heikinAshi[:-1].append(closed).append(heikinAshi(forming, closed[0]))[-self.window:]
+    self.candles = self.candles.append(forming)[-self.window:]
+    if self.pending is None:
+      self.pending = date
+    self.ticked = False
+    self.opening = True
+    return True
+
+  # Heikin Ashi including the candle that closed by now, None when the close wasn't
+  # covered by ticks and has to be fetched from the exchange
+  def close(self, now):
+    with self.lock:
+      if not len(self.candles):
+        return None
+      if now >= self.candles.date[-1] + self.period and not self.roll(now):
+        return None
+      return self.heikinAshi
+
+  def update(self, polo, end):
+    with self.updating:
+      return self.fetch(polo, end)
+
+  def fetch(self, polo, end):
+    with self.lock:
+      if self.pending is not None:
+        start = self.pending
+      elif len(self.candles):
+        start = int(self.candles.date[-1])
+        # Nothing closed since the last update, e.g. another period of the pair just fetched
+        if self.updated and end < start + self.period:
+          return 0
+      else:
+        start = end - self.period * self.window
+    # No lock while waiting on the exchange, ticks keep coming in
+    new = Chart.fromPoloniex(polo.returnChartData(self.pair, self.period, start, end))
+    log.debug(f'Got {len(new)} candles from poloniex')
+    self.updated = True
+    if not len(new):
+      return 0
+    with self.lock:
+      # Drop in memory candles that were fetched again, keep the newer ones built from ticks
+      keep = int(np.searchsorted(self.candles.date, new.date[0]))
+      after = int(np.searchsorted(self.candles.date, new.date[-1], side='right'))
+      prev = self.heikinAshi[keep - 1] if keep else None
+      ha = heikinAshi(new, prev)
+      self.verify(ha)
+      tail = self.candles[after:]
+      self.candles = self.candles[:keep].append(new).append(tail)[-self.window:]
+      self.heikinAshi = self.heikinAshi[:keep].append(ha).append(heikinAshi(tail, ha[-1]))[-self.window:]
+      # The last exchange candle is final once the exchange has a newer one
+      self.pending = int(new.date[-1]) if len(tail) else None
+      if not len(tail):
+        self.opening = False
+      closed = self.candles[:-1]
+      if self.pending is not None:
+        closed = closed[:int(np.searchsorted(closed.date, self.pending))]
+      closed = closed[int(np.searchsorted(closed.date, self.savedDate, side='right')):]
+      if len(closed):
+        appendCandles(self.path, closed)
+        self.savedDate = int(closed.date[-1])
+    return len(new)
+
+  # Date of the first candle the exchange hasn't confirmed, the forming one when all closed ones are
+  def confirmedUntil(self):
+    return self.pending if self.pending is not None else int(self.candles.date[-1])
+
+  # Reports candles built from ticks whose color the exchange candle doesn't confirm
+  def verify(self, ha):
+    if self.pending is None:
+      return
+    local = self.heikinAshi
+    for n in range(len(ha) - 1):
+      date = int(ha.date[n])
+      if date < self.pending:
+        continue
+      index = int(np.searchsorted(local.date, date))
+      if index >= len(local) - 1 or local.date[index] != date:
+        continue
+      if bool(local.green[index]) != bool(ha.green[n]):
+        log.warning(f'{self.pair} {self.period} candle {date} built from ticks was {local[index].color}, exchange candle is {ha[n].color}')
+        metrics.increment('candle_mismatch_total', pair=self.pair, period=self.period)
+
+# Period every longer one is resampled from
+BASE_PERIOD = 300
+
+# Candles of a longer period from consecutive shorter ones, grouped at the period
+# boundaries like the exchange groups them: first open, highest high, lowest low, last close.
+# A first group the chart starts inside of is dropped.
+def resample(chart, period):
+  if not len(chart):
+    return EMPTY
+  bucket = chart.date - chart.date % period
+  starts = np.flatnonzero(np.diff(bucket, prepend=bucket[0] - 1))
+  if chart.date[0] != bucket[0]:
+    starts = starts[1:]
+  if not len(starts):
+    return EMPTY
+  first = starts[0]
+  ends = np.append(starts[1:], len(chart)) - 1
+  return Chart(
+      bucket[starts],
+      chart.open[starts],
+      np.maximum.reduceat(chart.high[first:], starts - first),
+      np.minimum.reduceat(chart.low[first:], starts - first),
+      chart.close[ends]
+      )
+
+# Candles of a longer period built from the base period store of the pair, so one
+# exchange fetch serves every period. Ticks and updates go to the base store.
+# Resampled candles are written once all their base candles are confirmed, history
+# before the base window is fetched once for this period, and its overlap with the
+# resampled candles checks they are the exchange's own.
+class ResampledStore:
+  def __init__(self, base, period, window=1000, folder='data'):
+    self.base = base
+    self.pair = base.pair
+    self.period = period
+    self.window = window
+    self.path = storePath(base.pair, period, folder)
+    # Closed candles confirmed by the exchange and their Heikin Ashi
+    self.history = readCandles(self.path, window)
+    self.historyAshi = heikinAshi(self.history)
+    self.savedDate = int(self.history.date[-1]) if len(self.history) else 0
+    self.candles = self.history
+    self.heikinAshi = self.historyAshi
+    self.verified = False
+    self.lock = threading.Lock()
+    log.debug(f'Loaded {len(self.history)} {self.pair} {period} candles from {self.path}')
+
+  @property
+  def pending(self):
+    return self.base.pending
+
+  def tick(self, price, now):
+    self.base.tick(price, now)
+
+  # Date of the first candle with base candles the exchange hasn't confirmed
+  def confirmedUntil(self):
+    confirmed = self.base.confirmedUntil()
+    return confirmed - confirmed % self.period
+
+  def close(self, now):
+    if self.base.close(now) is None:
+      return None
+    self.rebuild()
+    return self.heikinAshi
+
+  def update(self, polo, end):
+    count = self.base.update(polo, end)
+    if not self.verified:
+      self.backfill(polo, end)
+    self.rebuild()
+    return count
+
+  def resampled(self):
+    with self.base.lock:
+      return resample(self.base.candles, self.period), self.base.confirmedUntil()
+
+  # Extends the history with closed candles whose base candles are all confirmed,
+  # then puts the newer resampled candles after it
+  def rebuild(self):
+    fresh, confirmed = self.resampled()
+    with self.lock:
+      new = fresh[int(np.searchsorted(fresh.date, self.savedDate, side='right')):]
+      final = new[:int(np.searchsorted(new.date + self.period, confirmed, side='right'))]
+      if len(final):
+        appendCandles(self.path, final)
+        self.savedDate = int(final.date[-1])
+        self.historyAshi = self.historyAshi.append(heikinAshi(final, self.historyAshi[-1] if len(self.historyAshi) else None))[-self.window:]
+        self.history = self.history.append(final)[-self.window:]
+      tail = new[len(final):]
+      self.candles = self.history.append(tail)[-self.window:]
+      self.heikinAshi = self.historyAshi.append(heikinAshi(tail, self.historyAshi[-1] if len(self.historyAshi) else None))[-self.window:]
+
+  # One fetch of this period for the candles missing before the base window,
+  # also covering the oldest resampled ones to compare them with the exchange
+  def backfill(self, polo, end):
+    fresh, confirmed = self.resampled()
+    start = self.savedDate + self.period if self.savedDate else end - self.period * self.window
+    if len(fresh):
+      start = min(start, int(fresh.date[0]))
+    exchange = Chart.fromPoloniex(polo.returnChartData(self.pair, self.period, start, end))
+    log.debug(f'Got {len(exchange)} {self.pair} {self.period} candles from poloniex')
+    self.verify(exchange, fresh[:int(np.searchsorted(fresh.date + self.period, confirmed, side='right'))])
+    # The last exchange candle can still be forming
+    closed = exchange[:int(np.searchsorted(exchange.date + self.period, end, side='right'))]
+    with self.lock:
+      closed = closed[int(np.searchsorted(closed.date, self.savedDate, side='right')):]
+      if len(fresh):
+        closed = closed[:int(np.searchsorted(closed.date, fresh.date[0]))]
+      if len(closed):
+        appendCandles(self.path, closed)
+        self.savedDate = int(closed.date[-1])
+        self.historyAshi = self.historyAshi.append(heikinAshi(closed, self.historyAshi[-1] if len(self.historyAshi) else None))[-self.window:]
+        self.history = self.history.append(closed)[-self.window:]
+    self.verified = True
+
+  # Resampled closed candles must be identical to the exchange candles of the same date
+  def verify(self, exchange, resampled):
+    dates, ours, theirs = np.intersect1d(resampled.date, exchange.date, return_indices=True)
+    fields = ('open', 'high', 'low', 'close')
+    differ = [n for n in range(len(dates))
+      if any(getattr(resampled, field)[ours[n]] != getattr(exchange, field)[theirs[n]] for field in fields)]
+    for n in differ[:5]:
+      log.warning(f'{self.pair} {self.period} resampled candle {resampled[ours[n]]} differs from exchange candle {exchange[theirs[n]]}')
+    if differ:
+      metrics.increment('resample_mismatch_total', len(differ), pair=self.pair, period=self.period)
+    log.info(f'{self.pair} {self.period} resampled candles checked against {len(dates)} exchange candles, {len(differ)} differ')
@@ -0,0 +1,111 @@
+import time
+import logging
+import threading
+import collections
+from email.utils import parsedate_to_datetime
+import metrics
+import sessions
+
+log = logging.getLogger('main')
+
+TIME_API = 'https://api.ipgeolocation.io/timezone?apiKey={key}&tz=Europe/London'
+
+# Wall time as a monotonic clock read plus an offset measured against remote clocks.
+# Each sample is taken at the midpoint of its request, so its error is half the round
+# trip plus half the resolution of the remote time. The sample with the smallest error,
+# grown by maxDrift per second since it was taken, is used, and the drift measured
+# between samples at least driftSpan apart carries it forward. Samples expire after
+# maxAge, with none left now() falls back to system time.
+class Clock:
+  def __init__(self, maxAge=3600, maxDrift=100e-6, driftSpan=1800, samples=64):
+    self.maxAge = maxAge
+    self.maxDrift = maxDrift
+    self.driftSpan = driftSpan
+    self.samples = collections.deque(maxlen=samples)
+    # Monotonic time, wall time at monotonic zero and drift of the estimate now() uses
+    self.estimate = None
+    self.expires = 0.0
+    self.stale = True
+    self.lock = threading.Lock()
+
+  def now(self):
+    mono = time.monotonic()
+    estimate = self.estimate
+    if estimate is None or mono >= self.expires:
+      if not self.stale:
+        self.stale = True
+        log.warning(f'No time sample in the last {self.maxAge}s, fallback to system time')
+      return time.time()
+    anchor, base, drift = estimate
+    return mono + base + drift * (mono - anchor)
+
+  # Remote time seen between the monotonic times sent and received
+  def sample(self, source, remote, sent, received, resolution=0.0):
+    mid = (sent + received) / 2
+    base = remote + resolution / 2 - mid
+    error = (received - sent) / 2 + resolution / 2
+    with self.lock:
+      self.samples.append((mid, base, error, source))
+      self.update(received)
+    metrics.gauge('clock_offset_seconds', base + time.monotonic() - time.time(), source=source)
+
+  def update(self, mono):
+    while self.samples and mono - self.samples[0][0] > self.maxAge:
+      self.samples.popleft()
+    if not self.samples:
+      return
+    best = min(self.samples, key=lambda sample: sample[2] + (mono - sample[0]) * self.maxDrift)
+    drift = self.drift()
+    self.estimate = (best[0], best[1], drift)
+    self.expires = self.samples[-1][0] + self.maxAge
+    if self.stale:
+      self.stale = False
+      log.info(f'Clock offset from system time: {self.offset():+.3f}s')
+    metrics.gauge('clock_error_seconds', best[2] + (mono - best[0]) * self.maxDrift)
+    metrics.gauge('clock_drift_ppm', drift * 1e6)
+
+  # Offset change per second between the best samples of the older and newer half,
+  # zero until they are far enough apart for sample errors not to swamp it
+  def drift(self):
+    samples = list(self.samples)
+    half = len(samples) // 2
+    if not half:
+      return 0.0
+    old = min(samples[:half], key=lambda sample: sample[2])
+    new = min(samples[half:], key=lambda sample: sample[2])
+    span = new[0] - old[0]
+    if span < self.driftSpan:
+      return 0.0
+    drift = (new[1] - old[1]) / span
+    return max(-self.maxDrift, min(self.maxDrift, drift))
+
+  # Difference to the system clock
+  def offset(self):
+    return self.now() - time.time()
+
+  # Samples the Date header of every response of a requests session,
+  # the header only has whole seconds
+  def watch(self, session, source='poloniex'):
+    def onResponse(response, *args, **kwargs):
+      date = response.headers.get('Date')
+      if not date:
+        return
+      received = time.monotonic()
+      try:
+        remote = parsedate_to_datetime(date).timestamp()
+      except (TypeError, ValueError):
+        return
+      self.sample(source, remote, received - response.elapsed.total_seconds(), received, resolution=1.0)
+    session.hooks['response'].append(onResponse)
+
+  # One time api request, raises ValueError with the api's message on errors
+  def syncTimeApi(self, key, timeout=5):
+    sent = time.monotonic()
+    response = sessions.get(TIME_API.format(key=key), timeout=timeout).json()
+    received = time.monotonic()
+    try:
+      remote = float(response['date_time_unix'])
+    except KeyError:
+      raise ValueError(response.get('message', 'no date_time_unix in time api response'))
+    self.sample('ipgeolocation', remote, sent, received)
+    return remote
@@ -0,0 +1,40 @@
+import asyncio
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger('main')
+
+# Blocking calls run on executors from the event loop.
+# Price checks and orders have their own lane so they never queue behind
+# chart fetches, Telegram or the time api.
+trading = ThreadPoolExecutor(max_workers=4, thread_name_prefix='trading')
+io = ThreadPoolExecutor(max_workers=8, thread_name_prefix='io')
+
+async def trade(fn, *args, **kwargs):
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(trading, functools.partial(fn, *args, **kwargs))
+
+async def run(fn, *args, **kwargs):
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(io, functools.partial(fn, *args, **kwargs))
+
+def _logFailure(future):
+  if not future.cancelled() and future.exception():
+    err = future.exception()
+    log.warning(f'Background call failed: {err!r}')
+
+# Fire and forget from sync code, e.g. notifications from the order path
+def background(fn, *args, **kwargs):
+  future = io.submit(fn, *args, **kwargs)
+  future.add_done_callback(_logFailure)
+  return future
+
+# Runs fn on the io lane every interval seconds until cancelled
+async def every(interval, fn, *args, **kwargs):
+  while True:
+    try:
+      await run(fn, *args, **kwargs)
+    except Exception as err:
+      log.warning(f'{fn.__name__} failed: {err!r}')
+    await asyncio.sleep(interval)
@@ -0,0 +1,155 @@
+import numpy as np
+import candles
+from candles import Candle
+
+# Streaming indicators with constant size state, update() takes one closed candle.
+# batch() gives the same values over a whole chart with the same float operations,
+# values are None, NaN in batches, until an indicator has enough candles.
+
+# Exponential average seeded with the simple average of the first length values
+class Average:
+  def __init__(self, length, alpha):
+    self.length = length
+    self.alpha = alpha
+    self.count = 0
+    self.total = 0.0
+    self.value = None
+
+  def update(self, x):
+    if self.value is None:
+      self.total += x
+      self.count += 1
+      if self.count == self.length:
+        self.value = self.total / self.length
+    else:
+      self.value = self.value + self.alpha * (x - self.value)
+    return self.value
+
+  def batch(self, values):
+    values = np.asarray(values, dtype=np.float64)
+    result = np.full(len(values), np.nan)
+    if len(values) < self.length:
+      return result
+    scan = np.empty(len(values) - self.length + 1, dtype=object)
+    # cumsum adds in order like update() does
+    scan[0] = float(np.cumsum(values[:self.length])[-1]) / self.length
+    scan[1:] = values[self.length:]
+    alpha = self.alpha
+    step = np.frompyfunc(lambda value, x: value + alpha * (x - value), 2, 1)
+    result[self.length - 1:] = step.accumulate(scan, dtype=object).astype(np.float64)
+    return result
+
+def ema(length):
+  return Average(length, 2 / (length + 1))
+
+def wilder(length):
+  return Average(length, 1 / length)
+
+class HeikinAshi:
+  def __init__(self):
+    self.prev = None
+    self.value = None
+
+  def update(self, candle):
+    close = round((candle.open + candle.high + candle.low + candle.close) / 4, 8)
+    prev = self.prev or candle
+    open = round((prev.open + prev.close) / 2, 8)
+    self.value = self.prev = Candle(candle.date, open, max(candle.high, candle.low, open, close),
+      min(candle.high, candle.low, open, close), close, open <= close)
+    return self.value
+
+  def batch(self, chart):
+    return candles.heikinAshi(chart)
+
+class EMA:
+  def __init__(self, length=20):
+    self.average = ema(length)
+    self.value = None
+
+  def update(self, candle):
+    self.value = self.average.update(candle.close)
+    return self.value
+
+  def batch(self, chart):
+    return ema(self.average.length).batch(chart.close)
+
+# Average true range with Wilder smoothing
+class ATR:
+  def __init__(self, length=14):
+    self.average = wilder(length)
+    self.prevClose = None
+    self.value = None
+
+  def update(self, candle):
+    if self.prevClose is None:
+      trueRange = candle.high - candle.low
+    else:
+      trueRange = max(candle.high - candle.low, abs(candle.high - self.prevClose), abs(candle.low - self.prevClose))
+    self.prevClose = candle.close
+    self.value = self.average.update(trueRange)
+    return self.value
+
+  def batch(self, chart):
+    if not len(chart):
+      return np.empty(0)
+    prevClose = chart.close[:-1]
+    trueRange = np.empty(len(chart))
+    trueRange[0] = chart.high[0] - chart.low[0]
+    trueRange[1:] = np.maximum.reduce((chart.high[1:] - chart.low[1:],
+      np.abs(chart.high[1:] - prevClose), np.abs(chart.low[1:] - prevClose)))
+    return wilder(self.average.length).batch(trueRange)
+
+# Relative strength index with Wilder smoothing, starts from the second candle's change
+class RSI:
+  def __init__(self, length=14):
+    self.length = length
+    self.gains = wilder(length)
+    self.losses = wilder(length)
+    self.prevClose = None
+    self.value = None
+
+  def update(self, candle):
+    if self.prevClose is not None:
+      change = candle.close - self.prevClose
+      gain = self.gains.update(max(change, 0.0))
+      loss = self.losses.update(max(-change, 0.0))
+      if gain is not None:
+        self.value = 100.0 if loss == 0 else 100 - 100 / (1 + gain / loss)
+    self.prevClose = candle.close
+    return self.value
+
+  def batch(self, chart):
+    result = np.full(len(chart), np.nan)
+    if len(chart) < 2:
+      return result
+    change = chart.close[1:] - chart.close[:-1]
+    gain = wilder(self.length).batch(np.maximum(change, 0.0))
+    loss = wilder(self.length).batch(np.maximum(-change, 0.0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+      rsi = 100 - 100 / (1 + gain / loss)
+    rsi[loss == 0] = 100.0
+    rsi[np.isnan(gain)] = np.nan
+    result[1:] = rsi
+    return result
+
+# Named indicators updated together on every closed candle
+class Indicators:
+  def __init__(self, **indicators):
+    self.indicators = indicators or {'ha':HeikinAshi(), 'ema':EMA(20), 'atr':ATR(14), 'rsi':RSI(14)}
+    self.date = 0
+
+  # Feeds the candles newer than the last one seen
+  def update(self, chart):
+    start = int(np.searchsorted(chart.date, self.date, side='right'))
+    for n in range(start, len(chart)):
+      candle = chart[n]
+      for indicator in self.indicators.values():
+        indicator.update(candle)
+      self.date = candle.date
+    return self.values()
+
+  def values(self):
+    return {name:indicator.value for name, indicator in self.indicators.items()}
+
+  def batch(self, chart):
+    return {name:indicator.batch(chart) for name, indicator in self.indicators.items()}
@@ -0,0 +1,135 @@
+import os
+import json
+import time
+import sqlite3
+import datetime
+import threading
+
+# Events are only ever inserted, positions and daily hold running totals
+# updated in the same transaction as the fill that changes them
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS events (
+  id INTEGER PRIMARY KEY,
+  time REAL NOT NULL,
+  pair TEXT NOT NULL,
+  period INTEGER NOT NULL,
+  kind TEXT NOT NULL,
+  price REAL,
+  amount REAL,
+  total REAL,
+  pnl REAL,
+  data TEXT
+);
+CREATE INDEX IF NOT EXISTS events_pair_time ON events (pair, time);
+CREATE INDEX IF NOT EXISTS events_time ON events (time);
+CREATE TRIGGER IF NOT EXISTS events_no_update BEFORE UPDATE ON events
+  BEGIN SELECT RAISE(ABORT, 'journal events are append only'); END;
+CREATE TRIGGER IF NOT EXISTS events_no_delete BEFORE DELETE ON events
+  BEGIN SELECT RAISE(ABORT, 'journal events are append only'); END;
+CREATE TABLE IF NOT EXISTS positions (
+  pair TEXT NOT NULL,
+  period INTEGER NOT NULL,
+  amount REAL NOT NULL,
+  cost REAL NOT NULL,
+  PRIMARY KEY (pair, period)
+);
+CREATE TABLE IF NOT EXISTS daily (
+  pair TEXT NOT NULL,
+  day TEXT NOT NULL,
+  trades INTEGER NOT NULL DEFAULT 0,
+  wins INTEGER NOT NULL DEFAULT 0,
+  pnl REAL NOT NULL DEFAULT 0,
+  volume REAL NOT NULL DEFAULT 0,
+  PRIMARY KEY (pair, day)
+);
+'''
+
+# Position amounts left below this after a sell are closed
+DUST = 1e-8
+
+def day(when):
+  return datetime.datetime.utcfromtimestamp(when).strftime('%Y-%m-%d')
+
+# Orders, position setups, stop moves and cancels in an SQLite file with write ahead logging.
+# A buy adds to the open position of its pair and period, a sell realizes it against
+# what the buys cost, so summaries read a few aggregate rows instead of every event.
+class Journal:
+  def __init__(self, path=os.path.join('data', 'journal.sqlite')):
+    folder = os.path.dirname(path)
+    if folder:
+      os.makedirs(folder, exist_ok=True)
+    self.path = path
+    self.db = sqlite3.connect(path, check_same_thread=False)
+    self.db.execute('PRAGMA journal_mode=WAL')
+    self.db.execute('PRAGMA synchronous=NORMAL')
+    self.db.executescript(SCHEMA)
+    self.lock = threading.Lock()
+
+  def close(self):
+    with self.lock:
+      self.db.close()
+
+  # price, amount and total are the fill of buys and sells, other values go to data
+  def record(self, pair, period, kind, price=None, amount=None, total=None, now=None, **data):
+    now = time.time() if now is None else now
+    with self.lock, self.db:
+      pnl = None
+      if kind == 'buy':
+        self.db.execute('INSERT INTO positions VALUES (?, ?, ?, ?) ON CONFLICT (pair, period) DO UPDATE '
+          'SET amount = amount + excluded.amount, cost = cost + excluded.cost', (pair, period, amount, total))
+        self.addDaily(pair, now, volume=total)
+      elif kind == 'sell':
+        position = self.db.execute('SELECT amount, cost FROM positions WHERE pair = ? AND period = ?', (pair, period)).fetchone()
+        # A partial sell realizes its share of the cost, the rest stays open
+        if position and amount is not None and position[0] - amount > DUST:
+          cost = position[1] * amount / position[0]
+          self.db.execute('UPDATE positions SET amount = amount - ?, cost = cost - ? WHERE pair = ? AND period = ?',
+            (amount, cost, pair, period))
+        else:
+          cost = position[1] if position else None
+          self.db.execute('DELETE FROM positions WHERE pair = ? AND period = ?', (pair, period))
+        # Positions opened before the journal have no cost, their sells don't count as trades
+        if position:
+          pnl = total - cost
+          self.addDaily(pair, now, trades=1, wins=int(pnl > 0), pnl=pnl, volume=total)
+        else:
+          self.addDaily(pair, now, volume=total)
+      self.db.execute('INSERT INTO events (time, pair, period, kind, price, amount, total, pnl, data) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (now, pair, period, kind, price, amount, total, pnl, json.dumps(data) if data else None))
+    return pnl
+
+  def addDaily(self, pair, now, trades=0, wins=0, pnl=0.0, volume=0.0):
+    self.db.execute('INSERT INTO daily VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (pair, day) DO UPDATE '
+      'SET trades = trades + excluded.trades, wins = wins + excluded.wins, '
+      'pnl = pnl + excluded.pnl, volume = volume + excluded.volume',
+      (pair, day(now), trades, wins, pnl, volume))
+
+  def query(self, sql, args=()):
+    with self.lock:
+      return self.db.execute(sql, args).fetchall()
+
+  # Realized PnL, trades and wins of each pair since a date, all time by default
+  def summary(self, since=None):
+    rows = self.query('SELECT pair, SUM(trades), SUM(wins), SUM(pnl), SUM(volume) FROM daily '
+      'WHERE day >= ? GROUP BY pair ORDER BY pair', (day(since) if since else '',))
+    return [{'pair':pair, 'trades':trades, 'wins':wins, 'win_rate':wins / trades if trades else 0.0,
+      'pnl':pnl, 'volume':volume} for pair, trades, wins, pnl, volume in rows]
+
+  # Totals of each day and base currency over the last days
+  def days(self, count=7, now=None):
+    now = time.time() if now is None else now
+    rows = self.query("SELECT day, substr(pair, 1, instr(pair, '_') - 1) AS base, SUM(trades), SUM(wins), SUM(pnl) "
+      'FROM daily WHERE day >= ? GROUP BY day, base ORDER BY day, base', (day(now - (count - 1) * 86400),))
+    return [{'day':date, 'base':base, 'trades':trades, 'wins':wins, 'pnl':pnl} for date, base, trades, wins, pnl in rows]
+
+  def events(self, pair=None, since=0, limit=100):
+    if pair:
+      rows = self.query('SELECT time, pair, period, kind, price, amount, total, pnl, data FROM events '
+        'WHERE pair = ? AND time >= ? ORDER BY time DESC LIMIT ?', (pair, since, limit))
+    else:
+      rows = self.query('SELECT time, pair, period, kind, price, amount, total, pnl, data FROM events '
+        'WHERE time >= ? ORDER BY time DESC LIMIT ?', (since, limit))
+    return [{'time':when, 'pair':pair, 'period':period, 'kind':kind, 'price':price, 'amount':amount,
+      'total':total, 'pnl':pnl, **(json.loads(data) if data else {})}
+      for when, pair, period, kind, price, amount, total, pnl, data in rows]
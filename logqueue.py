@@ -0,0 +1,85 @@
+import os
+import json
+import gzip
+import time
+import queue
+import atexit
+import shutil
+import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# One compact json object per line
+class JsonFormatter(logging.Formatter):
+  def format(self, record):
+    entry = {
+        'time':round(record.created, 3),
+        'level':record.levelname,
+        'logger':record.name,
+        'thread':record.threadName,
+        'message':record.getMessage()
+        }
+    if record.exc_info:
+      entry['exc'] = self.formatException(record.exc_info)
+    return json.dumps(entry, separators=(',', ':'), default=str)
+
+# Rotates when the file grows past maxBytes or is older than interval seconds,
+# rotated files are gzipped by the listener thread
+class RotatingJsonHandler(RotatingFileHandler):
+  def __init__(self, path, maxBytes=50 * 2**20, backupCount=14, interval=86400):
+    folder = os.path.dirname(path)
+    if folder:
+      os.makedirs(folder, exist_ok=True)
+    super().__init__(path, maxBytes=maxBytes, backupCount=backupCount, encoding='utf-8')
+    self.interval = interval
+    self.rolloverAt = time.time() + interval
+    self.setFormatter(JsonFormatter())
+
+  def namer(self, name):
+    return name + '.gz'
+
+  def rotator(self, source, dest):
+    with open(source, 'rb') as f, gzip.open(dest, 'wb') as compressed:
+      shutil.copyfileobj(f, compressed)
+    os.remove(source)
+
+  def shouldRollover(self, record):
+    if time.time() >= self.rolloverAt and os.path.getsize(self.baseFilename):
+      return True
+    return super().shouldRollover(record)
+
+  def doRollover(self):
+    super().doRollover()
+    self.rolloverAt = time.time() + self.interval
+
+# Lets through the first burst debug records of each call site per window, then one in every
+class DebugSampler(logging.Filter):
+  def __init__(self, every=10, burst=20, window=60):
+    super().__init__()
+    self.every = every
+    self.burst = burst
+    self.window = window
+    self.sites = {}
+
+  def filter(self, record):
+    if record.levelno > logging.DEBUG or self.every <= 1:
+      return True
+    key = (record.pathname, record.lineno)
+    count, start = self.sites.get(key, (0, record.created))
+    if record.created - start >= self.window:
+      count, start = 0, record.created
+    count += 1
+    self.sites[key] = (count, start)
+    return count <= self.burst or count % self.every == 0
+
+# Loggers only put records on a queue, a listener thread formats and writes them.
+# Returns the listener, it is flushed and stopped at exit.
+def start(loggers, handlers, sampleEvery=10):
+  records = queue.SimpleQueue()
+  handler = QueueHandler(records)
+  handler.addFilter(DebugSampler(sampleEvery))
+  for logger in loggers:
+    logger.addHandler(handler)
+  listener = QueueListener(records, *handlers, respect_handler_level=True)
+  listener.start()
+  atexit.register(listener.stop)
+  return listener
@@ -1,5 +1,4 @@
 import os
-import requests
 from requests.exceptions import Timeout
 import time
 import datetime
@@ -8,553 +7,991 @@ import logging
 import getopt
 import sys
 import traceback
+import threading
+import asyncio
 import api
+import candles
+import backtest
+import backfill
+import pricefeed
+import orderbook
+import engine
+import sessions
+import telegram
+import metrics
+import scheduler
+import logqueue
+import indicators
+import clock
+import journal
+import outbox
+from strategy import Strategy, MIN_BALANCE
+
+log = logging.getLogger('main')
+reqlog = logging.getLogger('urllib3')
 
-argList = sys.argv[1:]
 opts = 'h'
 longOpts = ['help', 'pair=', 'period=', 'tguser=',
             'maxrisk=', 'maxposition=',
             'polokey=', 'polosecret=',
-            'tick=', 'tguserid=', 'tgtoken=',
-            'loglevel=',
+            'tick=', 'tickerttl=', 'tguserid=', 'tgtoken=',
+            'loglevel=', 'backtest=', 'balance=',
+            'sweep=', 'sweeprisk=', 'backfill=', 'sweepposition=', 'workers=',
+            'wsurl=', 'websocket', 'orderbook',
+            'poolsize=', 'httptimeout=', 'retries=', 'metrics=', 'ratelimit=',
+            'logsize=', 'logbackups=', 'logsample=', 'timesync=',
             'prod', 'call', 'apitime', 'trade', 'notify', 'commands']
-tgupdateid = 0
 # Default options
-pair = 'USDT_BTC'
-period = 300
+pairs = ['USDT_BTC']
+periods = [300]
 prod = False
 tg_username = None
 call = False
 apitime = False
+timesync = 300
 private_api = False
 maxrisk = 0.05
 maxposition = False
 polokey = False
 polosecret = False
 tick = 5
+tickerttl = None
+websocket = False
+useOrderbook = False
+wsurl = pricefeed.URL
+poolsize = 4
+httptimeout = 10
+retries = 3
+metricsPort = None
+ratelimit = 6
+logsize = 50 * 2**20
+logbackups = 14
+logsample = 10
 trade = False
 tguserid = False
 tgtoken = False
 notify = False
 loglevel = logging.DEBUG
 commands = False
+backtestFile = False
+balance = 1000.0
+sweepPattern = False
+sweepRisks = False
+sweepPositions = False
+workers = None
+backfillDays = False
+# Set up by main()
+polo = None
+poloScheduler = None
+time_api_key = None
+timeClock = clock.Clock()
+tradeJournal = None
+messages = None
+calls = None
+logfolder = None
+filename = None
 
-try:
-  args, values = getopt.getopt(argList, opts, longOpts)
-  for arg, value in args:
-    if arg in ('-h', '--help'):
-      print(
+def parseArgs(argList):
+  global pairs, periods, prod, tg_username, maxrisk, maxposition, polokey, polosecret, tick, tickerttl, websocket, wsurl
+  global useOrderbook, poolsize, httptimeout, retries, metricsPort, ratelimit, tguserid, tgtoken, logsize, logbackups, logsample, loglevel
+  global call, apitime, timesync, trade, notify, commands, backtestFile, balance, sweepPattern, sweepRisks, sweepPositions, workers, backfillDays
+  try:
+    args, values = getopt.getopt(argList, opts, longOpts)
+    for arg, value in args:
+      if arg in ('-h', '--help'):
+        print(
 '''
 Arguments:
 --loglevel <level> - log level to display in terminal, default: DEBUG
---pair <pair> - currency pair, default: USDT_BTC
---period <period> - chart period (5m, 15m, 30m, 2h, 4h, 1d), default: 5m
+--logsize <megabytes> - size a json lines log file is rotated and gzipped at, rotated daily anyway, default: 50
+--logbackups <number> - rotated log files to keep, default: 14
+--logsample <number> - after 20 a minute, keep one in every <number> debug records of each log call, 1 keeps all, default: 10
+--pair <pairs> - comma separated currency pairs, default: USDT_BTC
+--period <periods> - comma separated chart periods (5m, 15m, 30m, 2h, 4h, 1d), default: 5m
 --maxrisk <amount persent> - maximum persent risk of total account on one trade, default: 5
 --maxposition <amount of currency> - maximum position size
 --polokey <key> - poloniex api key
 --polosecret <secret> - poloniex api secret
 --tick <time in seconds> - price check period in seconds
+--tickerttl <time in seconds> - how long a ticker snapshot is reused, default: --tick
+--websocket - check entry and stop loss on every push api price update, polls while disconnected
+--wsurl <url> - push api url for --websocket, default: wss://api2.poloniex.com
+--orderbook - price market orders from local order books kept by the push api, implies --websocket
+--poolsize <number> - keep-alive connections per host, default: 4
+--httptimeout <time in seconds> - http request timeout, default: 10
+--retries <number> - retries with backoff for telegram, callmebot and time api requests, default: 3
+--ratelimit <calls per second> - poloniex public and private api calls per second each, default: 6
+--metrics <port> - serve latency metrics on http://127.0.0.1:<port>/metrics, always written to logs at exit
 --tguser <telegram username> - user to call
 --tguserid <user id> - telegram user id to send notifications to
 --tgtoken <token> - telegram bot token
 --prod - writes separate logs for production run
 --call - enable calling in telegram with callmebot.com
 --apitime - use ipgeolocation.io instead of system time
+--timesync <time in seconds> - how often --apitime measures the clock offset, poloniex responses are also used, default: 300
 --trade - enable automated trading
 --notify - enable telegram notifications
---commands - enable telegram commands
+--commands - enable telegram commands: /balance, /journal with realized PnL and win rate from the trade journal
+--backtest <candle file> - run the strategy over a candle file and exit
+--balance <amount> - starting balance for --backtest and --sweep, default: 1000
+--sweep <candle files pattern> - backtest every candle file matching the pattern, e.g. "data/*-300.candles"
+--sweeprisk <persents> - comma separated max risk values for --sweep, default: --maxrisk
+--sweepposition <amounts> - comma separated max position sizes for --sweep, 0 for none, default: --maxposition
+--workers <number> - worker processes for --sweep, default: cpu count, download threads for --backfill, default: 8
+--backfill <days> - download the last <days> of --pair and --period candles into data and exit, resumes an interrupted download, the pairs shouldn't be traded meanwhile
 '''
-          )
-      sys.exit(0)
-    elif arg in ('--pair'):
-      pair = str(value.upper())
-    elif arg in ('--period'):
-      names = {
-          '5m':300,
-          '15m':900,
-          '30m':1800,
-          '2h':7200,
-          '4h':14400,
-          '1d':86400
-          }
-      try:
-        period = int(value)
-      except ValueError:
-        if value not in names.keys():
-          print(f'Invalid period "{value}", periods are 5m, 15m, 30m, 2h, 4h, 1d')
+            )
+        sys.exit(0)
+      elif arg in ('--pair'):
+        pairs = [pair.upper() for pair in value.split(',')]
+      elif arg in ('--period'):
+        names = {
+            '5m':300,
+            '15m':900,
+            '30m':1800,
+            '2h':7200,
+            '4h':14400,
+            '1d':86400
+            }
+        periods = []
+        for name in value.split(','):
+          try:
+            periods.append(int(name))
+          except ValueError:
+            if name not in names.keys():
+              print(f'Invalid period "{name}", periods are 5m, 15m, 30m, 2h, 4h, 1d')
+              sys.exit(1)
+            periods.append(names[name])
+      elif arg in ('--prod'):
+        prod = True
+      elif arg in ('--tguser'):
+        tg_username = str(value)
+      elif arg in ('--maxrisk'):
+        maxrisk = float(value) / 100
+        if maxrisk > 1 or maxrisk < 0.005:
+          print('--maxrisk must be between 0.005 and 1')
           sys.exit(1)
-        period = names[value]
-    elif arg in ('--prod'):
-      prod = True
-    elif arg in ('--tguser'):
-      tg_username = str(value)
-    elif arg in ('--maxrisk'):
-      maxrisk = float(value) / 100
-      if maxrisk > 1 or maxrisk < 0.005:
-        print('--maxrisk must be between 0.005 and 1')
-        sys.exit(1)
-    elif arg in ('--maxposition'):
-      maxposition = float(value)
-    elif arg in ('--polokey'):
-      polokey = value
-    elif arg in ('--polosecret'):
-      polosecret = value
-    elif arg in ('--tick'):
-      tick = float(value)
-    elif arg in ('--tguserid'):
-      tguserid = value
-    elif arg in ('--tgtoken'):
-      tgtoken = value
-    elif arg in ('--loglevel'):
-      names = {
-          'INFO':logging.INFO,
-          'DEBUG':logging.DEBUG,
-          'WARNING':logging.WARNING,
-          'ERROR':logging.ERROR
-          }
-      loglevel = names[value.upper()]
-    elif arg in ('--call'):
-      call = True
-    elif arg in ('--apitime'):
-      apitime = True
-    elif arg in ('--trade'):
-      trade = True
-    elif arg in ('--notify'):
-      notify = True
-    elif arg in ('--commands'):
-      commands = True
-except getopt.error as err:
-  print(str(err))
-  sys.exit(1)
-
-# Logger setup
-try:
-  os.makedirs(f'logs/{pair}')
-  print('Created logs folder')
-except FileExistsError:
-  pass
+      elif arg in ('--maxposition'):
+        maxposition = float(value)
+      elif arg in ('--polokey'):
+        polokey = value
+      elif arg in ('--polosecret'):
+        polosecret = value
+      elif arg in ('--tick'):
+        tick = float(value)
+      elif arg in ('--tickerttl'):
+        tickerttl = float(value)
+      elif arg in ('--websocket'):
+        websocket = True
+      elif arg in ('--wsurl'):
+        wsurl = value
+      elif arg in ('--orderbook'):
+        useOrderbook = True
+        websocket = True
+      elif arg in ('--poolsize'):
+        poolsize = int(value)
+      elif arg in ('--httptimeout'):
+        httptimeout = float(value)
+      elif arg in ('--retries'):
+        retries = int(value)
+      elif arg in ('--metrics'):
+        metricsPort = int(value)
+      elif arg in ('--ratelimit'):
+        ratelimit = float(value)
+      elif arg in ('--tguserid'):
+        tguserid = value
+      elif arg in ('--tgtoken'):
+        tgtoken = value
+      elif arg in ('--logsize'):
+        logsize = int(float(value) * 2**20)
+      elif arg in ('--logbackups'):
+        logbackups = int(value)
+      elif arg in ('--logsample'):
+        logsample = int(value)
+      elif arg in ('--loglevel'):
+        names = {
+            'INFO':logging.INFO,
+            'DEBUG':logging.DEBUG,
+            'WARNING':logging.WARNING,
+            'ERROR':logging.ERROR
+            }
+        loglevel = names[value.upper()]
+      elif arg in ('--call'):
+        call = True
+      elif arg in ('--apitime'):
+        apitime = True
+      elif arg in ('--timesync'):
+        timesync = float(value)
+      elif arg in ('--trade'):
+        trade = True
+      elif arg in ('--notify'):
+        notify = True
+      elif arg in ('--commands'):
+        commands = True
+      elif arg in ('--backtest'):
+        backtestFile = value
+      elif arg in ('--balance'):
+        balance = float(value)
+      elif arg in ('--sweep'):
+        sweepPattern = value
+      elif arg in ('--sweeprisk'):
+        sweepRisks = [float(risk) / 100 for risk in value.split(',')]
+      elif arg in ('--sweepposition'):
+        sweepPositions = [float(position) or False for position in value.split(',')]
+      elif arg in ('--workers'):
+        workers = int(value)
+      elif arg in ('--backfill'):
+        backfillDays = float(value)
+  except getopt.error as err:
+    print(str(err))
+    sys.exit(1)
+  api.setTickerTtl(tick if tickerttl is None else tickerttl)
+  sessions.configure(poolsize, httptimeout, retries)
+  scheduler.configure(ratelimit, ratelimit)
 
+def setupLogging():
+  global logfolder, filename
+  if len(pairs) == 1 and len(periods) == 1:
+    logfolder = pairs[0]
+    logname = f'{pairs[0]}{periods[0]}'
+  else:
+    logfolder = 'multi'
+    logname = f'multi{len(pairs) * len(periods)}'
+  try:
+    os.makedirs(f'logs/{logfolder}')
+    print('Created logs folder')
+  except FileExistsError:
+    pass
 
-log = logging.getLogger('main')
-log.setLevel(logging.DEBUG)
+  log.setLevel(logging.DEBUG)
+  reqlog.setLevel(logging.DEBUG)
 
-reqlog = logging.getLogger('urllib3')
-reqlog.setLevel(logging.DEBUG)
-
-filename = datetime.datetime.now().strftime('%Y-%m-%d') + f'-{pair}{period}-log'
-if prod:
-  filename += '-prod'
-file = logging.FileHandler(os.path.join('logs', pair, filename))
-file.setLevel(logging.DEBUG)
-fileformat = logging.Formatter('%(asctime)s:%(levelname)s:%(message)s')
-file.setFormatter(fileformat)
-log.addHandler(file)
-
-reqfile = logging.FileHandler(os.path.join('logs', filename + '-requests'))
-reqfile.setLevel(logging.DEBUG)
-fileformat = logging.Formatter('%(asctime)s:%(levelname)s:%(message)s')
-reqfile.setFormatter(fileformat)
-reqlog.addHandler(reqfile)
-
-stream = logging.StreamHandler()
-stream.setLevel(loglevel)
-streamformat = logging.Formatter('%(asctime)s:%(levelname)s:%(message)s')
-stream.setFormatter(fileformat)
-log.addHandler(stream)
-reqlog.addHandler(stream)
-
-log.info('========================')
-log.info('Start')
-
-# TG username setup
-if call:
-  if tg_username:
-    log.debug(f'Using tg username from command line parameter: {tg_username}')
-  else:
-    try:
-      tg_username = os.environ['TG_USER']
-      log.debug(f'Using tg username from environment variable: {tg_username}')
-    except KeyError as err:
-      log.error(f'--tguser parameter not passed, no environment vatiable {err}, exiting...')
-      sys.exit(1)
+  filename = f'{logname}-log'
+  if prod:
+    filename += '-prod'
+  # Json lines files written by a background thread, rotated daily or at --logsize and gzipped
+  file = logqueue.RotatingJsonHandler(os.path.join('logs', logfolder, filename + '.jsonl'), logsize, logbackups)
+  file.setLevel(logging.DEBUG)
+  file.addFilter(logging.Filter('main'))
 
-# TG notification bot setup
-if notify:
-  if tgtoken:
-    pass
-  else:
+  reqfile = logqueue.RotatingJsonHandler(os.path.join('logs', filename + '-requests.jsonl'), logsize, logbackups)
+  reqfile.setLevel(logging.DEBUG)
+  reqfile.addFilter(logging.Filter('urllib3'))
+
+  stream = logging.StreamHandler()
+  stream.setLevel(loglevel)
+  streamformat = logging.Formatter('%(asctime)s:%(levelname)s:%(message)s')
+  stream.setFormatter(streamformat)
+  logqueue.start([log, reqlog], [file, reqfile, stream], logsample)
+
+# Settings from arguments and environment variables only, network checks run later with the trading loops
+def setupCredentials():
+  global tg_username, tgtoken, tguserid, time_api_key
+  # TG username setup
+  if call:
+    if tg_username:
+      log.debug(f'Using tg username from command line parameter: {tg_username}')
+    else:
+      try:
+        tg_username = os.environ['TG_USER']
+        log.debug(f'Using tg username from environment variable: {tg_username}')
+      except KeyError as err:
+        log.error(f'--tguser parameter not passed, no environment vatiable {err}, exiting...')
+        sys.exit(1)
+  # TG notification bot setup
+  if notify:
+    if not tgtoken:
+      try:
+        tgtoken = os.environ['TG_TOKEN_TEST']
+      except KeyError as err:
+        log.error(f'{err} environment variable or --tgtoken should be set up to use --notify')
+        sys.exit(1)
+    if not tguserid:
+      try:
+        tguserid = os.environ['TG_USERID']
+      except KeyError as err:
+        log.error(f'{err} environment variable or --tguserid should be set up to use --notify')
+        sys.exit(1)
+  # Api time setup
+  if apitime:
     try:
-      tgtoken = os.environ['TG_TOKEN_TEST']
+      time_api_key = os.environ['TIME_API']
     except KeyError as err:
-      log.error(f'{err} environment variable or --tgtoken should be set up to use --notify')
+      log.error(f'No environment variable {err}, must be set to use --apitime, exiting...')
       sys.exit(1)
-  result = requests.get(f'https://api.telegram.org/bot{tgtoken}/getMe')
+
+# Poloniex api setup, the private api login is checked with the other startup checks
+def setupPoloniex():
+  global polo, poloScheduler, private_api
+  try:
+    if polokey and polosecret:
+      api_key = polokey
+      api_secret = polosecret
+      log.info('Using Poloniex api keys from arguments')
+    else:
+      api_key = os.environ['POLO_KEY']
+      api_secret = os.environ['POLO_SECRET']
+      log.info('Using Poloniex api keys from environment variables')
+    polo = Poloniex(key=api_key, secret=api_secret)
+    private_api = True
+  except KeyError:
+    polo = Poloniex()
+    log.info('No Poloniex api keys set, using public api only')
+  sessions.usePoloniex(polo)
+  metrics.instrument(polo)
+  poloScheduler = scheduler.install(polo)
+  # Poloniex response dates keep the clock in sync between time api requests
+  if apitime and getattr(polo, 'session', None) is not None:
+    timeClock.watch(polo.session)
+
+class StartupError(Exception):
+  pass
+
+def checkTelegram():
+  result = sessions.get(f'https://api.telegram.org/bot{tgtoken}/getMe')
   result = result.json()
-  if result['ok']:
-    log.info('Connected to telegram bot api')
-  else:
-    log.error('Invalid telegram token')
-    sys,exit(1)
-  if tguserid:
-    pass
-  else:
-    try:
-      print('Hello')
-      tguserid = os.environ['TG_USERID']
-    except KeyError as err:
-      log.error(f'{err} environment variable or --tguserid should be set up to use --notify')
-      sys.exit(1)
+  if not result['ok']:
+    raise StartupError('Invalid telegram token')
+  log.info('Connected to telegram bot api')
 
-# Poloniex api setup
-try:
-  if polokey and polosecret:
-    api_key = polokey
-    api_secret = polosecret
-    log.info('Using Poloniex api keys from arguments')
-  else:
-    api_key = os.environ['POLO_KEY']
-    api_secret = os.environ['POLO_SECRET']
-    log.info('Using Poloniex api keys from environment variables')
-  polo = Poloniex(key=api_key, secret=api_secret)
-  private_api = True
-  api.getAllBalances(polo, total=True)
+def checkPoloniex():
+  try:
+    api.getAllBalances(polo, total=True)
+  except PoloniexError as err:
+    raise StartupError(f'Poloniex: {err}')
   log.info(f'Logged on to Poloniex private api')
-except KeyError:
-  polo = Poloniex()
-  log.info('No Poloniex api keys set, using public api only')
-except PoloniexError as err:
-  log.error(f'Poloniex: {err}')
-  sys.exit(1)
-
-# Api time setup
-if apitime:
+
+def checkApiTime():
   try:
-    time_api_key = os.environ['TIME_API']
-    responce = requests.get(f'https://api.ipgeolocation.io/timezone?apiKey={time_api_key}&tz=Europe/London', timeout=10)
-    responce = responce.json()
-  except KeyError as err:
-    log.error(f'No environment variable {err}, must be set to use --apitime, exiting...')
-    sys.exit(1)
+    unixTime = timeClock.syncTimeApi(time_api_key, timeout=10)
   except Timeout:
-    log.error('Request to ipgeolocation.io timed out')
-    sys.exit(1)
-  try:
-    unixTime = responce['date_time_unix']
-    log.info(f'Connected to ipgeolocation.io, current unix time: {unixTime}')
-  except KeyError:
-    log.error(responce['message'])
-    sys.exit(1)
+    raise StartupError('Request to ipgeolocation.io timed out')
+  except ValueError as err:
+    raise StartupError(str(err))
+  log.info(f'Connected to ipgeolocation.io, current unix time: {unixTime}')
+
+# Startup checks run side by side, and alongside restored stops and chart loads
+async def startupChecks():
+  checks = []
+  if notify:
+    checks.append(checkTelegram)
+  if private_api:
+    checks.append(checkPoloniex)
+  if apitime:
+    checks.append(checkApiTime)
+  await asyncio.gather(*(engine.run(check) for check in checks))
 
-# End of setup
 
+# No requests here, the clock is synced in the background
 def getCurrentTime():
   if apitime:
-    try:
-      responce = requests.get(f'https://api.ipgeolocation.io/timezone?apiKey={time_api_key}&tz=Europe/London', timeout=5)
-      responce = responce.json()
-      unixTime = responce['date_time_unix']
-      return unixTime
-    except KeyError:
-      log.warning(responce['message'])
-      log.warning('Fallback to system time')
-    except Timeout:
-      log.warning('Request to ipgeolocation.io timed out')
-      log.warning('Fallback to system time')
+    return timeClock.now()
   return time.time()
 
-def tg_call(user, text):
-  url = f'http://api.callmebot.com/start.php?source=web&user={user}&text={text}&lang=en-IN-Standard-A&rpt=5'
-  return requests.post(url)
-
-def tg_message(text):
-  if not notify:
-    return 0
-  text = f'{datetime.datetime.now()}\n{pair}-{period}\n{text}'
-  url = f'https://api.telegram.org/bot{tgtoken}/sendMessage?chat_id={tguserid}&text={text}'
-  log.debug(f'Sending message to user_id {tguserid}:\n{text}')
-  return requests.get(url)
-
-def tg_getUpdates(updateid):
-  url = f'https://api.telegram.org/bot{tgtoken}/getUpdates?offset={updateid}'
-  response = requests.get(url)
-  response = response.json()
-  return response
-
-def tg_handleUpdates(updateid):
-  updates = tg_getUpdates(updateid)
-  reqlog.debug(updates)
+def syncTime():
   try:
-    for update in updates['result']:
-      updateid = update['update_id'] + 1
-      message = update['message']
-      chatid = message['chat']['id']
-      log.debug(f'Received from chat_id {chatid}:\n{message["text"]}')
-      if chatid == int(tguserid):
-        if message['text'] == '/balance':
-          tg_sendBalance()
-    return updateid
-  except KeyError as e:
-    log.warning((traceback.format_exc()))
-    
+    timeClock.syncTimeApi(time_api_key)
+  except Timeout:
+    log.warning('Request to ipgeolocation.io timed out')
+
+# The first time api sample is taken by the startup check
+async def timeSyncLoop():
+  await asyncio.sleep(timesync)
+  await engine.every(timesync, syncTime)
+
+def callmebot(user, text):
+  params = {'source':'web', 'user':user, 'text':text, 'lang':'en-IN-Standard-A', 'rpt':5}
+  sessions.post('http://api.callmebot.com/start.php', params=params).raise_for_status()
+
+# Messages and calls are queued and sent by outbox threads, never from the order path
+def setupNotifications():
+  global messages, calls
+  if notify:
+    messages = outbox.Outbox('telegram', telegram.sender(tgtoken), os.path.join('data', 'outbox-telegram.json')).start()
+  if call:
+    calls = outbox.Outbox('callmebot', callmebot, os.path.join('data', 'outbox-callmebot.json'), interval=30).start()
+
+def tg_call(user, text):
+  if calls:
+    calls.put(user, text)
+
+def tg_message(text, name=None):
+  if not messages:
+    return
+  if not name:
+    name = ','.join(f'{pair}-{period}' for pair in pairs for period in periods)
+  text = f'{datetime.datetime.now()}\n{name}\n{text}'
+  log.debug(f'Queueing message to user_id {tguserid}:\n{text}')
+  messages.put(tguserid, text)
 
 def tg_sendBalance():
-  msg = 'Poloniex balance'
-  msg += '\nTotal: ' + str(api.getTotalBalance(polo)) + ' USDT'
-  balances = api.getAllBalances(polo)
-  print(balances)
-  for coin in balances:
-    coinBalance = float(balances[coin]['available']) + float(balances[coin]['onOrders'])
-    usdtValue = float(balances[coin]['btcValue']) * api.getTicker(polo, 'USDT_BTC')
-    msg += f'\n{coin}: {coinBalance}  ~  {usdtValue:.8f} USDT'
+  # Reporting waits behind trading calls
+  with scheduler.lane('reporting'):
+    msg = 'Poloniex balance'
+    msg += '\nTotal: ' + str(api.getTotalBalance(polo)) + ' USDT'
+    balances = api.getAllBalances(polo)
+    print(balances)
+    for coin in balances:
+      coinBalance = float(balances[coin]['available']) + float(balances[coin]['onOrders'])
+      usdtValue = float(balances[coin]['btcValue']) * api.getTicker(polo, 'USDT_BTC')
+      msg += f'\n{coin}: {coinBalance}  ~  {usdtValue:.8f} USDT'
   tg_message(msg)
 
-def getChartData(pair, period, start, end, lastCandleDate=None):
-  if lastCandleDate:
-    end = getCurrentTime()
-    log.debug(f'Last candle date: {lastCandleDate}, {datetime.datetime.utcfromtimestamp(lastCandleDate)}')
-  chart = []
-  data = polo.returnChartData(pair, period, start, end)
-  log.debug(f'Got {len(data)} candles from poloniex')
-  log.debug(f'New candle date: {data[-1]["date"]}, {datetime.datetime.utcfromtimestamp(data[-1]["date"])}')
-  if lastCandleDate == data[-1]['date']:
-    log.debug('New candle is the same, retrying in 15 seconds...')
-    time.sleep(15)
-    return getChartData(pair, period, start, end, lastCandleDate)
-  for candle in data:
-    if float(candle['open']) > float(candle['close']):
-      color = 'red'
-    else:
-      color = 'green'
-    chart.append(
-        {
-          'date':int(candle['date']),
-          'open':float(candle['open']),
-          'close':float(candle['close']),
-          'high':float(candle['high']),
-          'low':float(candle['low']),
-          'color':color
-        })
+def tg_sendJournal():
+  if not tradeJournal:
+    return
+  msg = 'Trade journal'
+  for row in tradeJournal.summary():
+    base = row['pair'].split('_')[0]
+    msg += f'\n{row["pair"]}: {row["trades"]} trades, {row["win_rate"]*100:.0f}% wins, PnL: {row["pnl"]:.8f} {base}'
+  msg += '\nLast 7 days'
+  for row in tradeJournal.days(7):
+    msg += f'\n{row["day"]}: {row["trades"]} trades, {row["wins"]} wins, PnL: {row["pnl"]:.8f} {row["base"]}'
+  tg_message(msg)
+
+def getChartData(store):
+  store.update(polo, getCurrentTime())
+  chart = store.candles
+  log.debug(f'New candle date: {chart[-1].date}, {datetime.datetime.utcfromtimestamp(chart[-1].date)}')
   return chart
 
-def getHeikinAshi(pair, period, start, end, lastCandleDate=None):
-  data = getChartData(pair, period, start, end, lastCandleDate)
-  chart = []
-  chart.append(data[0])
-  for candle in data:
-    open = ( chart[-1]['open'] + chart[-1]['close'] ) / 2
-    open = float(f'{open:.8f}')
-    close = ( candle['open'] + candle['high'] + candle['low'] + candle['close'] ) / 4
-    close = float(f'{close:.8f}')
-    high = max(candle['high'], candle['low'], open, close)
-    low = min(candle['high'], candle['low'], open, close)
-    if open > close:
-      color = 'red'
-    else:
-      color = 'green'
-    chart.append(
-        {
-          'date':int(candle['date']),
-          'open':open,
-          'close':close,
-          'high':high,
-          'low':low,
-          'color':color
-        })
-  chart.pop(0)
-  log.debug(f'Converted {len(chart)} candles to Heikin Ashi')
+def getHeikinAshi(store):
+  getChartData(store)
+  chart = store.heikinAshi
+  log.debug(f'Heikin Ashi has {len(chart)} candles')
   return chart
 
-def mainLoop(pair, period):
-  global tgupdateid
-  base, coin = pair.split('_')
-  position_open = False
-  position_size = False
-  position_entry = False
-  position_stopLoss = False
-  expected_risk_persent = False
-  expected_risk = False
-  now = getCurrentTime()
-  chart = getHeikinAshi(pair, period, now - period * 1000, now)
-  log.debug('Last five candles:')
-  for candle in chart[-5:]:
-    log.debug(candle)
-  lastCandleDate = chart[-1]['date']
-  log.debug(f'Current candle date: {lastCandleDate}, {datetime.datetime.utcfromtimestamp(lastCandleDate)}')
-  if trade:
-    currentCoinBalance = float(polo.returnBalances()[coin])
-    if currentCoinBalance:
-      log.info(f'Found available balance of {currentCoinBalance} {coin}, calculating stop loss...')
-      n = -1
-      while not position_stopLoss:
-        lastCandleColor = chart[n-1]['color']
-        candleBeforeColor = chart[n-2]['color']
-        if candleBeforeColor != lastCandleColor:
-          position_stopLoss = float(chart[n-1]['low'])
-          log.info(f'Stop loss set to {position_stopLoss}')
-          # tg_message(f'Stop loss set to {position_stopLoss}')
-          position_open = True
-          log.debug(f'position_open: {position_open}')
-        n -= 1
+# Prefixes log messages with the pair and period when trading several
+class TraderLog(logging.LoggerAdapter):
+  def process(self, msg, kwargs):
+    return f'{self.extra["name"]}: {msg}', kwargs
+
+# One pair and period with its own candles and position state
+class Trader:
+  def __init__(self, pair, period, multi=False, store=None):
+    self.pair = pair
+    self.period = period
+    self.base, self.coin = pair.split('_')
+    self.name = f'{pair}-{period}'
+    self.log = TraderLog(log, {'name':self.name}) if multi else log
+    self.strategy = Strategy(pair, maxrisk, maxposition, self.log, os.path.join('data', f'{self.name}.position'))
+    if trade:
+      self.strategy.load()
+    self.store = store or candles.CandleStore(pair, period)
+    self.indicators = indicators.Indicators()
+    self.chart = None
+    self.nextCandleTime = 0
+    self.book = None
+    self.reconciling = None
+    # Candle date, kind and prior stop loss of the last setup or stop move decided on a
+    # candle built from ticks, decided again once the exchange confirms the candle
+    self.unconfirmed = None
+    # Restored entries wait until resume() has checked the balance
+    self.resumed = False
+    # Traders of the other periods of the pair share its coin balance
+    self.siblings = [self]
+    self.pairLock = threading.Lock()
+    # Monotonic time the next order may be sent after a failed one
+    self.retryAt = 0
+    self.retryDelay = 0
+    # Ticks can come from the price feed thread
+    self.lock = threading.Lock()
+
+  # Journal failures are logged, they never get in the way of trading
+  def record(self, kind, **fields):
+    if not tradeJournal:
+      return
+    try:
+      tradeJournal.record(self.pair, self.period, kind, now=getCurrentTime(), **fields)
+    except Exception as err:
+      self.log.warning(f'Trade journal write failed: {err!r}')
+
+  # Before resume() only the stop loss of an open position is checked, a restored
+  # entry may already have filled before the restart
+  def armed(self):
+    strategy = self.strategy
+    if not self.resumed:
+      return bool(strategy.position_open and strategy.position_stopLoss)
+    return bool(strategy.position_entry or strategy.position_stopLoss)
+
+  # Coin balance of the pair less what the open positions of its other periods bought
+  def ownBalance(self, balance):
+    claimed = sum(other.strategy.position_amount or 0 for other in self.siblings
+      if other is not self and other.strategy.position_open)
+    return max(0.0, round(balance - claimed, 8))
+
+  def start(self, ticker=None):
+    chart = getHeikinAshi(self.store)
+    with self.lock:
+      self.resume(chart, ticker)
+
+  def resume(self, chart, ticker=None):
+    self.chart = chart
+    self.nextCandleTime = chart[-1].date + self.period
+    self.log.debug('Last five candles:')
+    for candle in chart[-5:]:
+      self.log.debug(candle)
+    lastCandleDate = chart[-1].date
+    self.log.debug(f'Current candle date: {lastCandleDate}, {datetime.datetime.utcfromtimestamp(lastCandleDate)}')
+    if trade:
+      # Periods of a pair resume one at a time, each claims its part of the balance
+      with self.pairLock:
+        self.resumeBalance(chart, ticker)
+    self.resumed = True
+
+  def resumeBalance(self, chart, ticker):
+    strategy = self.strategy
+    currentCoinBalance = self.ownBalance(float(polo.returnBalances()[self.coin]))
+    if strategy.order_pending == 'buy':
+      # Crashed while buying, the balance tells whether the order filled
+      if currentCoinBalance:
+        self.log.info(f'Buy order sent before the restart filled, {currentCoinBalance} {self.coin}')
+        strategy.opened(currentCoinBalance)
+        self.record('restore', stop=strategy.position_stopLoss, amount=currentCoinBalance)
+      else:
+        self.log.info('Buy order sent before the restart did not fill, removing the entry')
+        strategy.closed()
+        self.record('cancel')
+    elif strategy.position_open and not currentCoinBalance:
+      self.log.info(f'No {self.coin} balance for the restored position, closing it')
+      strategy.closed()
+    elif strategy.position_open or (strategy.position_entry and not currentCoinBalance):
+      self.log.info('Keeping restored position')
+      if strategy.order_pending:
+        self.log.info('Sell order sent before the restart did not fill, keeping the stop loss')
+      if strategy.position_open and strategy.position_entry:
+        self.log.info('Removing the entry left armed on the open position')
+        strategy.position_entry = False
+      if strategy.position_open and (not strategy.position_amount or strategy.position_amount > currentCoinBalance):
+        self.log.info(f'Position amount set to the {currentCoinBalance} {self.coin} balance')
+        strategy.position_amount = currentCoinBalance
+      strategy.order_pending = False
+      strategy.save()
+    elif currentCoinBalance:
+      self.log.info(f'Found available balance of {currentCoinBalance} {self.coin}, calculating stop loss...')
+      if strategy.restore(chart, currentCoinBalance):
+        self.record('restore', stop=strategy.position_stopLoss, amount=currentCoinBalance)
     else:
-      print('Check')
-      currentPrice = api.getTicker(polo, pair)
-      lastCandleColor = chart[-2]['color']
-      candleBeforeColor = chart[-3]['color']
-      if lastCandleColor == 'green' and candleBeforeColor == 'red':
-        total_balance = api.getTotalBalance(polo)
-        position_entry = chart[-2]['high']
-        position_stopLoss = chart[-2]['low']
-        if currentPrice < position_entry and currentPrice > position_stopLoss:
-          candle_change = 1 - ( chart[-2]['low'] / chart[-2]['high'] )
-          maxloss = total_balance * maxrisk
-          available_balance = float(polo.returnBalances()[base])
-          position_size = min(maxloss / candle_change, available_balance)
-          if maxposition:
-            position_size = min(position_size, maxposition)
-          expected_risk = position_size * candle_change
-          expected_risk_persent = expected_risk / total_balance
-          position_size = float(f'{position_size:.8f}')
-          log.info(f'Candle risk: {candle_change * 100:.3f}%')
-          log.info(f'Available balance: {available_balance} {base}')
-          log.info(f'Position entry: {position_entry}')
-          log.info(f'Position stop loss: {position_stopLoss}')
-          log.info(f'Position size: {position_size} {base}')
-          log.info(f'Expected risk: {expected_risk_persent*100:.2f}%, {expected_risk:.8f} {base}')
-#           tg_message(f'''New position setup
-# Candle risk: {candle_change * 100:.3f}%
-# Available balance: {available_balance} {base}
-# Position entry: {position_entry}
-# Position stop loss: {position_stopLoss}
-# Position size: {position_size} {base}
-# Expected risk: {expected_risk_persent*100:.2f}%, {expected_risk:.8f} {base}
-# ''')
-  while True:
-    now = getCurrentTime()
-    fromLastCandle = now % period
-    untilNextCandle = period - fromLastCandle
-    log.info(f'Waiting {datetime.datetime.utcfromtimestamp(untilNextCandle).strftime("%H:%M:%S")} until new candle...')
-    nextCandleTime = chart[-1]['date'] + period
-    log.debug(f'Next candle date: {nextCandleTime}')
-    # Tick check
-    while getCurrentTime() < nextCandleTime:
-      if commands:
-        tgupdateid = tg_handleUpdates(tgupdateid)
-      if trade:
-        currentPrice = api.getTicker(polo, pair)
-        if position_entry and currentPrice > position_entry:
-          log.info(f'Entry price of {position_entry} hit, buying {coin}...')
-          coinBefore = float(polo.returnBalances()[coin])
-          baseBefore = float(polo.returnBalances()[base])
-          result = api.buy(polo, pair, market=True, total=position_size)
-          log.debug(result)
-          coinAfter = float(polo.returnBalances()[coin])
-          baseAfter = float(polo.returnBalances()[base])
-          coinAmount = f'{coinAfter - coinBefore:.8f}'
-          baseAmount = f'{baseBefore - baseAfter:.8f}'
-          log.info(f'Bought {coinAmount} {coin} for {baseAmount} {base} at {currentPrice}')
-          tg_message(f'''Entry price hit
+      if ticker is None:
+        ticker = api.getTicker(polo)
+      currentPrice = float(ticker[self.pair]['last'])
+      if strategy.signal(chart[-2], chart[-3]) == 'buy':
+        if currentPrice < chart[-2].high and currentPrice > chart[-2].low:
+          total_balance = api.getTotalBalance(polo)
+          available_balance = float(polo.returnBalances()[self.base])
+          if strategy.setup(chart[-2], total_balance, available_balance):
+            self.recordSetup()
+
+  def setup(self, candle):
+    total_balance = api.getTotalBalance(polo)
+    available_balance = float(polo.returnBalances()[self.base])
+    if available_balance > MIN_BALANCE and self.strategy.setup(candle, total_balance, available_balance):
+      self.recordSetup()
+      return True
+    return False
+
+  def recordSetup(self):
+    strategy = self.strategy
+    self.record('setup', price=strategy.position_entry, stop=strategy.position_stopLoss,
+      size=strategy.position_size, risk=strategy.expected_risk)
+
+  def onTick(self, currentPrice):
+    with self.lock:
+      pair, base, coin = self.pair, self.base, self.coin
+      strategy = self.strategy
+      action = strategy.check(currentPrice)
+      if action == 'buy' and not self.resumed:
+        return
+      # Orders wait out the backoff of a failed one instead of firing on every tick
+      if action in ('buy', 'sell') and time.monotonic() < self.retryAt:
+        return
+      if action == 'buy':
+        self.log.info(f'Entry price of {strategy.position_entry} hit, buying {coin}...')
+        strategy.ordering('buy')
+        try:
+          with metrics.timer('decision_fill_seconds', side='buy'):
+            result = api.buy(polo, pair, market=True, total=strategy.position_size, book=self.book)
+          self.log.debug(result)
+          coinFilled, baseFilled = api.getFill(result)
+          if not coinFilled:
+            # Nothing of it may fill later without a position to hold it
+            api.cancelOrders(polo, result)
+            raise ValueError(f'nothing filled: {result}')
+        except Exception as err:
+          self.buyFailed(err, currentPrice)
+          return
+        self.retryDelay = 0
+        coinAmount = f'{coinFilled:.8f}'
+        baseAmount = f'{baseFilled:.8f}'
+        self.log.info(f'Bought {coinAmount} {coin} for {baseAmount} {base} at {currentPrice}')
+        self.record('buy', price=currentPrice, amount=coinFilled, total=baseFilled, order=result.get('orderNumber') if isinstance(result, dict) else None)
+        tg_message(f'''Entry price hit
 {pair} Buy
 Rate: {currentPrice}
 Amount: {coinAmount} {coin}
-Total:{baseAmount} {base}''')
-          position_open = True
-          log.debug(f'position_open: {position_open}')
-          position_entry = False
-          log.debug('Position entry removed')
-        if position_open and currentPrice < position_stopLoss:
-          log.info(f'Stop loss of {position_stopLoss} hit, selling {coin}...')
-          coinBefore = float(polo.returnBalances()[coin])
-          baseBefore = float(polo.returnBalances()[base])
-          result = api.sell(polo, pair, market=True, all=True)
-          log.debug(result)
-          coinAfter = float(polo.returnBalances()[coin])
-          baseAfter = float(polo.returnBalances()[base])
-          coinAmount = f'{coinBefore - coinAfter:.8f}'
-          baseAmount = f'{baseAfter - baseBefore:.8f}'
-          log.info(f'Sold {coinAmount} {coin} for {baseAmount} {base} at {currentPrice}')
-          tg_message(f'''Stop loss hit
+Total:{baseAmount} {base}''', self.name)
+        strategy.opened(coinFilled)
+      elif action == 'sell':
+        self.log.info(f'Stop loss of {strategy.position_stopLoss} hit, selling {coin}...')
+        try:
+          # Only what this position bought, other periods of the pair keep theirs
+          with self.pairLock:
+            amount = self.ownBalance(api.Balances(polo)[coin])
+            if strategy.position_amount:
+              amount = min(amount, strategy.position_amount)
+            if not amount:
+              self.log.info(f'No {coin} balance left for the position, closing it')
+              strategy.closed()
+              return
+            strategy.ordering('sell')
+            with metrics.timer('decision_fill_seconds', side='sell'):
+              result = api.sell(polo, pair, market=True, amount=f'{amount:.8f}', book=self.book)
+          self.log.debug(result)
+          coinFilled, baseFilled = api.getFill(result)
+          if not coinFilled:
+            api.cancelOrders(polo, result)
+            raise ValueError(f'nothing filled: {result}')
+        except Exception as err:
+          # The stop loss stays armed and is tried again after the backoff
+          self.orderFailed('sell', err)
+          return
+        self.retryDelay = 0
+        coinAmount = f'{coinFilled:.8f}'
+        baseAmount = f'{baseFilled:.8f}'
+        self.log.info(f'Sold {coinAmount} {coin} for {baseAmount} {base} at {currentPrice}')
+        self.record('sell', price=currentPrice, amount=coinFilled, total=baseFilled, order=result.get('orderNumber') if isinstance(result, dict) else None)
+        tg_message(f'''Stop loss hit
 {pair} Sell
 Rate: {currentPrice}
 Amount: {coinAmount} {coin}
-Total: {baseAmount} {base}''')
-          position_stopLoss = False
-          log.debug('Position stop loss removed')
-          position_entry = False
-          log.debug('Position entry removed')
-          position_open = False
-          log.debug(f'Position open: {position_open}')
-        if position_stopLoss and not position_open and currentPrice < position_stopLoss:
-          log.info('Entry not hit, position cancelled')
-          # tg_message('Entry not hit, position cancelled')
-          position_stopLoss = False
-          log.debug('Position stop loss removed')
-          position_entry = False
-          log.debug('Position entry removed')
-          position_open = False
-          log.debug(f'position_open: {position_open}')
-      time.sleep(tick)
-
-    lastCandleDate = chart[-1]['date']
-    log.info('Getting new candle...')
-    chart = getHeikinAshi(pair, period, now - period * 1000, now, chart[-1]['date'])
-    lastCandleColor = chart[-2]['color']
-    candleBeforeColor = chart[-3]['color']
-    log.debug(chart[-3])
-    log.debug(chart[-2])
-    log.debug(chart[-1])
-    log.info(f'Candle pattern is {candleBeforeColor} = > {lastCandleColor}')
-    if lastCandleColor == 'green' and candleBeforeColor == 'red':
-      log.info('Time to buy')
-      if private_api:
-        total_balance = api.getTotalBalance(polo)
-        available_balance = float(polo.returnBalances()[base])
-        if available_balance > 2:
-          position_entry = chart[-2]['high']
-          position_stopLoss = chart[-2]['low']
-          candle_change = 1 - ( chart[-2]['low'] / chart[-2]['high'] )
-          maxloss = total_balance * maxrisk
-          position_size = min(maxloss / candle_change, available_balance)
-          if maxposition:
-            position_size = min(position_size, maxposition)
-          expected_risk = position_size * candle_change
-          expected_risk_persent = expected_risk / total_balance
-          position_size = float(f'{position_size:.8f}')
-          log.info(f'Candle risk: {candle_change * 100:.3f}%')
-          log.info(f'Available balance: {available_balance} {base}')
-          log.info(f'Position entry: {position_entry}')
-          log.info(f'Position stop loss: {position_stopLoss}')
-          log.info(f'Position size: {position_size} {base}')
-          log.info(f'Expected risk: {expected_risk_persent*100:.2f}%, {expected_risk:.8f} {base}')
-#           tg_message(f'''New position setup
-# Candle risk: {candle_change * 100:.3f}%
-# Available balance: {available_balance} {base}
-# Position entry: {position_entry}
-# Position stop loss: {position_stopLoss}
-# Position size: {position_size} {base}
-# Expected risk: {expected_risk_persent*100:.2f}%, {expected_risk:.8f} {base}
-# ''')
+Total: {baseAmount} {base}''', self.name)
+        left = round(amount - coinFilled, 8)
+        if left * currentPrice >= MIN_BALANCE:
+          # Partly filled, the rest stays the position and the stop loss fires again
+          self.log.warning(f'Sell filled {coinAmount} of {amount:.8f} {coin}, keeping {left:.8f} {coin} under the stop loss')
+          strategy.position_amount = left
+          strategy.order_pending = False
+          strategy.save()
+        else:
+          strategy.closed()
+      elif action == 'cancel':
+        strategy.cancel()
+        self.record('cancel', price=currentPrice)
+
+  # Failed orders are reported and backed off, the next one waits 5 seconds doubling up to 5 minutes
+  def orderFailed(self, side, err):
+    self.retryDelay = min(max(self.retryDelay * 2, 5), 300)
+    self.retryAt = time.monotonic() + self.retryDelay
+    self.log.error(f'{self.coin} {side} order failed: {err!r}, next order in {self.retryDelay} seconds')
+    tg_message(f'''Order failed
+{self.pair} {side.capitalize()}
+Error: {err!r}''', self.name)
+
+  # A failed buy may still have filled, coin the balance has beyond the positions of
+  # the pair is this position, without any the entry is removed so it won't buy again
+  def buyFailed(self, err, currentPrice):
+    strategy = self.strategy
+    self.orderFailed('buy', err)
+    try:
+      with self.pairLock:
+        bought = self.ownBalance(api.Balances(polo)[self.coin])
+      if strategy.position_open:
+        bought = round(bought - (strategy.position_amount or 0), 8)
+    except Exception as balanceErr:
+      self.log.error(f'Balance check after the failed buy failed: {balanceErr!r}, removing the entry')
+      bought = 0
+    if bought * currentPrice >= MIN_BALANCE:
+      self.log.warning(f'Found {bought:.8f} {self.coin} bought despite the error, opening the position with it')
+      self.record('restore', stop=strategy.position_stopLoss, amount=bought)
+      strategy.opened(bought)
+    elif strategy.position_open:
+      strategy.position_entry = False
+      strategy.order_pending = False
+      strategy.save()
+    else:
+      strategy.cancel()
+      self.record('cancel', price=currentPrice)
+
+  # Prices from the tick loop or the price feed, they also build the forming candle
+  def onPrice(self, price, now=None):
+    self.store.tick(price, getCurrentTime() if now is None else now)
+    if trade and self.armed():
+      self.onTick(price)
+
+  async def onCandle(self, now):
+    chart = await engine.run(self.store.close, now)
+    if chart is None:
+      self.log.info('Getting new candle...')
+      chart = await self.fetchCandle(self.chart[-1].date)
+    else:
+      self.log.debug('New candle built from ticks')
+      if not self.reconciling or self.reconciling.done():
+        self.reconciling = asyncio.create_task(self.reconcile())
+    await engine.run(self.closeCandle, chart)
+
+  # Exchange candles when ticks didn't cover the close, until the new candle is published
+  async def fetchCandle(self, lastCandleDate):
+    delay = 1
+    while True:
+      chart = await engine.run(getHeikinAshi, self.store)
+      if chart[-1].date != lastCandleDate:
+        return chart
+      self.log.debug(f'New candle is not published yet, retrying in {delay} seconds...')
+      metrics.increment('candle_retries_total')
+      await asyncio.sleep(delay)
+      delay = min(delay * 2, 30)
+
+  # Replaces candles built from ticks with the exchange ones once they are published,
+  # fetched at least once as another period of the pair may have confirmed them already
+  async def reconcile(self):
+    delay = 5
+    while True:
+      await asyncio.sleep(delay)
+      try:
+        await engine.run(getChartData, self.store)
+        if self.store.pending is None:
+          break
+      except Exception as err:
+        self.log.warning(f'Candle reconciliation failed: {err!r}, retrying in {delay * 2} seconds...')
+      delay = min(delay * 2, 60)
+    try:
+      await engine.run(self.amend)
+    except Exception as err:
+      self.log.error(f'Amending the decision failed: {err!r}')
+
+  # Ticks only sample the high and low, an entry or stop loss set from a candle built
+  # from them is set again from the exchange candle, or undone when its signal is gone
+  def amend(self):
+    with self.lock:
+      if not self.unconfirmed or self.unconfirmed[0] >= self.store.confirmedUntil():
+        return
+      date, kind, stop = self.unconfirmed
+      self.unconfirmed = None
+      chart = self.store.heikinAshi
+      index = int(chart.date.searchsorted(date))
+      if not 0 < index < len(chart) - 1 or chart.date[index] != date:
+        return
+      strategy = self.strategy
+      candle = chart[index]
+      signal = strategy.signal(candle, chart[index - 1])
+      if kind == 'setup' and strategy.position_entry:
+        if signal != 'buy':
+          self.log.warning(f'Exchange candle {date} is {candle.color}, no buy signal, removing the entry')
+          if strategy.position_open:
+            strategy.position_entry = False
+            strategy.position_stopLoss = stop
+            strategy.save()
+            self.record('stop', price=stop)
+          else:
+            strategy.cancel()
+            self.record('cancel')
+        elif strategy.position_entry != candle.high or strategy.position_stopLoss != candle.low:
+          self.log.info(f'Exchange candle {date} differs from the one built from ticks, setting the position up again')
+          self.setup(candle)
+      elif kind == 'stop' and signal not in ('pullback', 'red') and strategy.position_open:
+        self.log.warning(f'Exchange candle {date} is {candle.color}, moving the stop loss back to {stop}')
+        strategy.position_stopLoss = stop
+        strategy.save()
+        self.record('stop', price=stop)
+      elif strategy.position_open and strategy.position_stopLoss != candle.low:
+        self.log.info(f'Exchange candle {date} low differs from the one built from ticks')
+        strategy.moveStop(candle)
+        self.record('stop', price=strategy.position_stopLoss)
+
+  def closeCandle(self, chart):
+    with self.lock:
+      self.decide(chart)
+
+  def decide(self, chart):
+    pair = self.pair
+    strategy = self.strategy
+    self.chart = chart
+    self.nextCandleTime = chart[-1].date + self.period
+    self.log.debug(chart[-3])
+    self.log.debug(chart[-2])
+    self.log.debug(chart[-1])
+    self.log.info(f'Candle pattern is {chart[-3].color} = > {chart[-2].color}')
+    # Only candles the exchange confirmed are fed in, candles built from ticks are never
+    # fed again once reconciled, so values lag a candle until the exchange publishes it
+    confirmed = self.store.candles
+    values = self.indicators.update(confirmed[:int(confirmed.date.searchsorted(self.store.confirmedUntil()))])
+    self.log.debug(f'EMA: {values["ema"]}, ATR: {values["atr"]}, RSI: {values["rsi"]}')
+    strategy.lastCandleDate = chart[-2].date
+    strategy.save()
+    signal = strategy.signal(chart[-2], chart[-3])
+    stop = strategy.position_stopLoss
+    kind = None
+    if signal == 'buy':
+      self.log.info('Time to buy')
+      if private_api and self.setup(chart[-2]):
+        kind = 'setup'
       if call:
-        log.info('Calling {tg_username}...')
+        self.log.info('Calling {tg_username}...')
         tg_call(tg_username, f'Time to buy {pair}')
-    elif lastCandleColor == 'red' and candleBeforeColor == 'green':
-      log.info('Time to move stop loss')
-      if private_api and position_open:
-        position_stopLoss = chart[-2]['low']
-        log.info(f'Position stop loss moved to {position_stopLoss}')
-        # tg_message(f'Position stop loss moved to {position_stopLoss}')
+    elif signal == 'pullback':
+      self.log.info('Time to move stop loss')
+      if private_api and strategy.position_open:
+        strategy.moveStop(chart[-2])
+        self.record('stop', price=strategy.position_stopLoss)
+        kind = 'stop'
       if call:
-        log.info('Calling {tg_username}...')
+        self.log.info('Calling {tg_username}...')
         tg_call(tg_username, f'Move stop loss on {pair}')
-    elif lastCandleColor == 'red' and position_open:
-      position_stopLoss = chart[-2]['low']
-      log.info(f'Position stop loss moved to {position_stopLoss}')
-      # tg_message(f'Position stop loss moved to {position_stopLoss}')
+    elif signal == 'red':
+      strategy.moveStop(chart[-2])
+      self.record('stop', price=strategy.position_stopLoss)
+      kind = 'stop'
     else:
-      log.info('Nothing to do...')
+      self.log.info('Nothing to do...')
+    if kind:
+      self.unconfirmed = (int(chart[-2].date), kind, stop) if chart[-2].date >= self.store.confirmedUntil() else None
+    # Candle close is the open of the forming candle
+    metrics.observe('candle_decision_seconds', getCurrentTime() - chart[-1].date, period=self.period)
 
-if __name__ == '__main__':
+# Candle closes of one trader as its own task, a failing or slow trader only holds up
+# itself, errors are logged and retried with backoff
+async def traderLoop(trader, ticker):
+  delay = 5
+  while True:
+    try:
+      await engine.run(trader.start, ticker)
+      break
+    except Exception as err:
+      trader.log.error(f'Loading candles failed: {err!r}, retrying in {delay} seconds...')
+      await asyncio.sleep(delay)
+      delay = min(delay * 2, 300)
+      ticker = None
+  delay = 5
+  while True:
+    nextCandleTime = trader.nextCandleTime
+    now = getCurrentTime()
+    untilNextCandle = max(0, nextCandleTime - now)
+    trader.log.info(f'Waiting {datetime.datetime.utcfromtimestamp(untilNextCandle).strftime("%H:%M:%S")} until new candle...')
+    trader.log.debug(f'Next candle date: {nextCandleTime}')
+    while now < nextCandleTime:
+      await asyncio.sleep(nextCandleTime - now)
+      now = getCurrentTime()
+    log.debug(f'Ticker cache hits: {api.tickerStats["hits"]}, misses: {api.tickerStats["misses"]}')
+    log.debug(f'Connections: {sessions.connectionStats()}')
+    log.debug(f'Poloniex call lanes: {poloScheduler.stats()}')
+    try:
+      await trader.onCandle(now)
+      delay = 5
+    except Exception as err:
+      trader.log.error(f'Candle close failed: {err!r}, retrying in {delay} seconds...')
+      trader.log.debug(traceback.format_exc())
+      await asyncio.sleep(delay)
+      delay = min(delay * 2, 300)
+
+async def candleLoop(traders):
+  # Restored stops are already checked by the tick loop while charts load
+  ticker = None
+  if trade:
+    try:
+      ticker = await engine.trade(api.getTicker, polo)
+    except Exception as err:
+      log.warning(f'Ticker failed: {err!r}, each trader gets its own')
+  await asyncio.gather(*(traderLoop(trader, ticker) for trader in traders))
+
+async def tickLoop(traders, feed):
+  loop = asyncio.get_running_loop()
+  wake = loop.time()
+  while True:
+    metrics.observe('tick_jitter_seconds', max(0, loop.time() - wake))
+    # Polls while the price feed is down, one ticker request covers every pair
+    if not (feed and feed.live()):
+      ticker = await engine.trade(api.getTicker, polo)
+      now = getCurrentTime()
+      await asyncio.gather(*(engine.trade(trader.onPrice, float(ticker[trader.pair]['last']), now) for trader in traders))
+    wake = loop.time() + tick
+    await asyncio.sleep(tick)
+
+async def runTasks(traders, feed):
+  tasks = [startupChecks(), tickLoop(traders, feed), candleLoop(traders)]
+  if apitime:
+    tasks.append(timeSyncLoop())
+  await asyncio.gather(*tasks)
+
+# Longer periods are resampled from the base period candles of their pair,
+# one chart fetch per pair covers them all
+def candleStores(pairs, periods):
+  window = max(1000, 2 * max(periods) // candles.BASE_PERIOD)
+  for pair in pairs:
+    base = candles.CandleStore(pair, candles.BASE_PERIOD, window)
+    for period in periods:
+      if period == candles.BASE_PERIOD:
+        yield pair, period, base
+      elif period % candles.BASE_PERIOD == 0:
+        yield pair, period, candles.ResampledStore(base, period)
+      else:
+        yield pair, period, candles.CandleStore(pair, period)
+
+def mainLoop(pairs, periods):
+  global tradeJournal
+  tradeJournal = journal.Journal(os.path.join('data', 'journal.sqlite'))
+  multi = len(pairs) * len(periods) > 1
+  traders = [Trader(pair, period, multi, store) for pair, period, store in candleStores(pairs, periods)]
+  pairLocks = {}
+  for trader in traders:
+    trader.siblings = [other for other in traders if other.pair == trader.pair]
+    trader.pairLock = pairLocks.setdefault(trader.pair, threading.Lock())
+  if commands:
+    telegram.CommandService(tgtoken, tguserid, {'/balance':tg_sendBalance, '/journal':tg_sendJournal}).start()
+  if metricsPort:
+    metrics.serve(metricsPort)
+  feed = None
+  if websocket:
+    ticker = api.getTicker(polo)
+    byPair = {}
+    for trader in traders:
+      byPair.setdefault(trader.pair, []).append(trader)
+    def onPrice(pair, price):
+      for trader in byPair.get(pair, []):
+        trader.onPrice(price)
+    books = {}
+    if useOrderbook:
+      for pair in byPair:
+        books[pair] = orderbook.OrderBook(pair)
+        for trader in byPair[pair]:
+          trader.book = books[pair]
+    feed = pricefeed.PriceFeed({pair:ticker[pair]['id'] for pair in byPair}, onPrice, wsurl, books).start()
+  asyncio.run(runTasks(traders, feed))
+
+def main(argList=None):
+  parseArgs(sys.argv[1:] if argList is None else argList)
+
+  # Backtest mode
+  if backtestFile:
+    report = backtest.runFile(backtestFile, pairs[0], periods[0], maxrisk, maxposition, balance)
+    print(backtest.formatReport(report))
+    return
+
+  # Parameter sweep mode
+  if sweepPattern:
+    reports = backtest.sweep(sweepPattern, sweepRisks or [maxrisk], sweepPositions or [maxposition], balance, workers)
+    print(backtest.formatTable(reports))
+    return
+
+  # Candle history download mode, rate limited by the scheduler
+  if backfillDays:
+    setupPoloniex()
+    now = int(time.time())
+    results = backfill.backfill(polo, pairs, periods, now - int(backfillDays * 86400), now, workers or 8)
+    for (pair, period), result in results.items():
+      if result['failed']:
+        print(f'{pair}-{period}: {result["failed"]} chunks failed, run again to resume')
+      else:
+        print(f'{pair}-{period}: {result["candles"]} candles, {result["fetched"]} chunks downloaded')
+    return
+
+  setupLogging()
+  log.info('========================')
+  log.info('Start')
+  setupCredentials()
+  setupPoloniex()
+  setupNotifications()
   log.info(f'Production: {prod}')
-  log.info(f'Pair: {pair}, period: {period}')
+  log.info(f'Pairs: {", ".join(pairs)}, periods: {", ".join(str(period) for period in periods)}')
   log.info(f'Call: {call}, username: {tg_username}')
   log.info(f'Poloniex private api: {private_api}')
   log.info(f'Max risk: {maxrisk*100}%')
@@ -565,7 +1002,7 @@ if __name__ == '__main__':
   tg_message(
 f'''Crypto Trader started
 Production: {prod}
-Pair: {pair}, period: {period}
+Pairs: {", ".join(pairs)}, periods: {", ".join(str(period) for period in periods)}
 Call: {call}, username: {tg_username}
 Poloniex private api: {private_api}
 Max risk: {maxrisk*100}%
@@ -574,9 +1011,19 @@ Tick period: {tick} seconds
 Automated trading: {trade}
 ''')
   try:
-    mainLoop(pair, period)
+    mainLoop(pairs, periods)
+  except StartupError as err:
+    log.error(err)
+    sys.exit(1)
   except Exception as e:
     tg_message(f'''Crypto Trader closed with an exception
 {e}
 See logs for traceback''')
     log.error((traceback.format_exc()))
+  finally:
+    if messages:
+      messages.drain()
+    metrics.dump(os.path.join('logs', logfolder, filename + '-metrics'))
+
+if __name__ == '__main__':
+  main()
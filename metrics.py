@@ -0,0 +1,144 @@
+import time
+import bisect
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+log = logging.getLogger('main')
+
+# Latency buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram:
+  def __init__(self):
+    self.counts = [0] * (len(BUCKETS) + 1)
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+    self.sum += value
+    self.count += 1
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_gauges = {}
+_help = {
+    'api_call_seconds':'Poloniex api call latency',
+    'http_request_seconds':'Telegram, callmebot and time api request latency',
+    'tick_jitter_seconds':'Delay of price checks past their tick interval',
+    'candle_decision_seconds':'Candle close to strategy decision delay',
+    'decision_fill_seconds':'Entry or stop loss trigger to order response delay',
+    'candle_retries_total':'Close not covered by ticks and the new candle not published yet, chart fetch retried',
+    'candle_mismatch_total':'Candles built from ticks whose Heikin Ashi color the exchange candle changed',
+    'resample_mismatch_total':'Candles resampled from the base period that differ from the exchange candles',
+    'scheduler_wait_seconds':'Time Poloniex calls waited in their scheduler lane',
+    'scheduler_queue_depth':'Poloniex calls waiting in each scheduler lane',
+    'scheduler_coalesced_total':'Poloniex calls answered by an identical call',
+    'clock_offset_seconds':'Last measured offset of each time source from system time',
+    'clock_error_seconds':'Error bound of the time used by --apitime',
+    'clock_drift_ppm':'Measured drift of system time against the time sources'
+    }
+
+def _key(name, labels):
+  return (name, tuple(sorted(labels.items())))
+
+def observe(name, value, **labels):
+  with _lock:
+    key = _key(name, labels)
+    if key not in _histograms:
+      _histograms[key] = Histogram()
+    _histograms[key].observe(value)
+
+def increment(name, value=1, **labels):
+  with _lock:
+    key = _key(name, labels)
+    _counters[key] = _counters.get(key, 0) + value
+
+def gauge(name, value, **labels):
+  with _lock:
+    _gauges[_key(name, labels)] = value
+
+@contextmanager
+def timer(name, **labels):
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    observe(name, time.perf_counter() - start, **labels)
+
+# Times every call of the named polo methods, labelled by method name
+def instrument(polo, calls=('returnTicker', 'returnChartData', 'returnBalances',
+    'returnCompleteBalances', 'returnOrderBook', 'buy', 'sell', 'cancelOrder')):
+  for call in calls:
+    method = getattr(polo, call, None)
+    if method is None:
+      continue
+    def timed(*args, method=method, call=call, **kwargs):
+      with timer('api_call_seconds', call=call):
+        return method(*args, **kwargs)
+    setattr(polo, call, functools.wraps(method)(timed))
+  return polo
+
+def _labels(labels, extra=()):
+  labels = list(labels) + list(extra)
+  if not labels:
+    return ''
+  return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+# Prometheus text exposition format
+def render():
+  lines = []
+  with _lock:
+    histograms = sorted(_histograms.items())
+    counters = sorted(_counters.items())
+    gauges = sorted(_gauges.items())
+  described = set()
+  for (name, labels), histogram in histograms:
+    if name not in described:
+      described.add(name)
+      lines.append(f'# HELP {name} {_help.get(name, name)}')
+      lines.append(f'# TYPE {name} histogram')
+    total = 0
+    for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+      total += count
+      lines.append(f'{name}_bucket{_labels(labels, [("le", bound)])} {total}')
+    lines.append(f'{name}_sum{_labels(labels)} {histogram.sum:.6f}')
+    lines.append(f'{name}_count{_labels(labels)} {histogram.count}')
+  for kind, values in (('counter', counters), ('gauge', gauges)):
+    for (name, labels), value in values:
+      if name not in described:
+        described.add(name)
+        lines.append(f'# HELP {name} {_help.get(name, name)}')
+        lines.append(f'# TYPE {name} {kind}')
+      lines.append(f'{name}{_labels(labels)} {value}')
+  return '\n'.join(lines) + '\n'
+
+class MetricsHandler(BaseHTTPRequestHandler):
+  def do_GET(self):
+    if self.path != '/metrics':
+      self.send_error(404)
+      return
+    body = render().encode()
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+def serve(port, host='127.0.0.1'):
+  server = ThreadingHTTPServer((host, port), MetricsHandler)
+  threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+  log.info(f'Metrics on http://{host}:{port}/metrics')
+  return server
+
+def dump(path):
+  with open(path, 'w') as f:
+    f.write(render())
+  log.info(f'Metrics written to {path}')
@@ -0,0 +1,108 @@
+import logging
+import threading
+
+log = logging.getLogger('main')
+
+# Smallest amount an order can have, 8 decimals
+DUST = 1e-8
+
+# Local order book of one pair, built from a snapshot and kept up to date with push api diffs.
+# Only the best depth levels of each side are kept.
+class OrderBook:
+  def __init__(self, pair, depth=100):
+    self.pair = pair
+    self.depth = depth
+    self.asks = {}
+    self.bids = {}
+    self.seq = None
+    self.lock = threading.Lock()
+
+  def ready(self):
+    return self.seq is not None and bool(self.asks) and bool(self.bids)
+
+  def reset(self):
+    with self.lock:
+      self.asks = {}
+      self.bids = {}
+      self.seq = None
+
+  # Snapshot from returnOrderBook or the push api, sides map price to amount
+  def load(self, asks, bids, seq):
+    with self.lock:
+      self.asks = {float(price):float(amount) for price, amount in asks.items()}
+      self.bids = {float(price):float(amount) for price, amount in bids.items()}
+      self.seq = seq
+      self.trim()
+
+  # Push api channel message: [pair id, seq, [['i', ...], ['o', side, price, amount], ['t', ...]]]
+  # Returns False on a sequence gap, the book then needs a new snapshot
+  def apply(self, seq, updates):
+    for update in updates:
+      if update[0] == 'i':
+        asks, bids = update[1]['orderBook']
+        self.load(asks, bids, seq)
+        return True
+    with self.lock:
+      if self.seq is None or seq <= self.seq:
+        return True
+      if seq != self.seq + 1:
+        log.warning(f'{self.pair} order book sequence gap {self.seq} => {seq}, waiting for a new snapshot')
+        self.asks = {}
+        self.bids = {}
+        self.seq = None
+        return False
+      self.seq = seq
+      for update in updates:
+        if update[0] != 'o':
+          continue
+        side = self.bids if int(update[1]) == 1 else self.asks
+        price = float(update[2])
+        amount = float(update[3])
+        if amount:
+          side[price] = amount
+        else:
+          side.pop(price, None)
+      if len(self.asks) > self.depth * 2 or len(self.bids) > self.depth * 2:
+        self.trim()
+    return True
+
+  def trim(self):
+    if len(self.asks) > self.depth:
+      self.asks = dict(sorted(self.asks.items())[:self.depth])
+    if len(self.bids) > self.depth:
+      self.bids = dict(sorted(self.bids.items(), reverse=True)[:self.depth])
+
+  def levels(self, side):
+    with self.lock:
+      if side == 'buy':
+        return sorted(self.asks.items())
+      return sorted(self.bids.items(), reverse=True)
+
+  # Splits an order into (rate, amount) chunks, each within maxImpact of its best level
+  def split(self, side, amount=False, total=False, maxImpact=0.005):
+    chunks = []
+    chunkStart = None
+    chunkRate = None
+    chunkAmount = 0.0
+    for price, size in self.levels(side):
+      if amount:
+        size = min(size, amount)
+        amount -= size
+      elif total:
+        size = min(size, total / price)
+        total -= size * price
+      if chunkStart is not None and abs(price / chunkStart - 1) > maxImpact:
+        chunks.append((chunkRate, chunkAmount))
+        chunkStart = None
+        chunkAmount = 0.0
+      if chunkStart is None:
+        chunkStart = price
+      chunkRate = price
+      chunkAmount += size
+      # Float residue of the subtractions is no order left
+      if (amount if amount is not False else total) < DUST:
+        break
+    else:
+      return None
+    chunks.append((chunkRate, chunkAmount))
+    return chunks
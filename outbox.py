@@ -0,0 +1,125 @@
+import time
+import queue
+import logging
+import threading
+import storage
+
+log = logging.getLogger('main')
+
+# Raised by a deliver function when the receiver asks to wait before sending again
+class RetryAfter(Exception):
+  def __init__(self, seconds):
+    super().__init__(f'retry after {seconds} seconds')
+    self.seconds = seconds
+
+# Raised by a deliver function for messages that will never go through, they are dropped
+class Rejected(Exception):
+  pass
+
+# Outbound messages sent by a background thread. put() only queues, so senders never wait
+# on the network. Messages to a target arriving within window seconds of each other go out
+# as one, a target gets at most one message every interval seconds, failures back off.
+# Unsent messages are kept in a json file and sent after a restart.
+class Outbox:
+  def __init__(self, name, deliver, path=None, window=2, interval=1, maxLength=4096):
+    self.name = name
+    self.deliver = deliver
+    self.path = path
+    self.window = window
+    self.interval = interval
+    self.maxLength = maxLength
+    self.queue = queue.SimpleQueue()
+    # [target, text] in the order they were put
+    self.pending = storage.readJson(path, []) if path else []
+    self.nextSend = {}
+    self.backoff = {}
+    self.stopped = False
+    self.thread = None
+
+  def put(self, target, text):
+    self.queue.put([target, text])
+
+  def start(self):
+    if self.pending:
+      log.info(f'{len(self.pending)} unsent {self.name} messages restored')
+    self.thread = threading.Thread(target=self.run, name=f'outbox-{self.name}', daemon=True)
+    self.thread.start()
+    return self
+
+  def stop(self):
+    self.stopped = True
+
+  # Waits up to timeout for everything queued to be sent, e.g. before exiting
+  def drain(self, timeout=5):
+    end = time.monotonic() + timeout
+    while (self.pending or not self.queue.empty()) and time.monotonic() < end:
+      time.sleep(0.1)
+    return not self.pending
+
+  def save(self):
+    if self.path:
+      storage.writeJson(self.path, self.pending)
+
+  # Seconds until a target can be sent to, None with nothing to send
+  def wait(self):
+    if not self.pending:
+      return None
+    now = time.monotonic()
+    return max(0, min(self.nextSend.get(target, 0) for target, text in self.pending) - now)
+
+  def run(self):
+    while not self.stopped:
+      try:
+        self.pending.append(self.queue.get(timeout=self.wait()))
+        self.save()
+        end = time.monotonic() + self.window
+        while True:
+          remaining = end - time.monotonic()
+          if remaining <= 0:
+            break
+          try:
+            self.pending.append(self.queue.get(timeout=remaining))
+          except queue.Empty:
+            break
+          self.save()
+      except queue.Empty:
+        pass
+      try:
+        self.flush()
+      except Exception as err:
+        log.warning(f'Sending {self.name} messages failed: {err!r}')
+
+  # One merged message to every target that isn't waiting
+  def flush(self):
+    now = time.monotonic()
+    for target in list(dict.fromkeys(target for target, text in self.pending)):
+      if self.nextSend.get(target, 0) > now:
+        continue
+      batch = []
+      length = 0
+      for item in self.pending:
+        if item[0] != target:
+          continue
+        if batch and length + len(item[1]) + 2 > self.maxLength:
+          break
+        batch.append(item)
+        length += len(item[1]) + 2
+      text = '\n\n'.join(text for target, text in batch)[:self.maxLength]
+      try:
+        self.deliver(target, text)
+        self.backoff.pop(target, None)
+        self.nextSend[target] = time.monotonic() + self.interval
+      except RetryAfter as err:
+        log.warning(f'{self.name} rate limited, retrying in {err.seconds} seconds...')
+        self.nextSend[target] = time.monotonic() + err.seconds
+        continue
+      except Rejected as err:
+        log.error(f'{self.name} message rejected: {err}, dropping it')
+      except Exception as err:
+        delay = self.backoff[target] = min(self.backoff.get(target, self.interval) * 2, 300)
+        log.warning(f'{self.name} message failed: {err!r}, retrying in {delay} seconds...')
+        self.nextSend[target] = time.monotonic() + delay
+        continue
+      sent = set(map(id, batch))
+      self.pending = [item for item in self.pending if id(item) not in sent]
+      self.save()
@@ -0,0 +1,105 @@
+import json
+import time
+import logging
+import threading
+import websocket
+
+log = logging.getLogger('main')
+
+URL = 'wss://api2.poloniex.com'
+TICKER_CHANNEL = 1002
+HEARTBEAT_CHANNEL = 1010
+# Seconds without any message, heartbeats included, before the feed counts as down
+STALE = 10
+
+# Poloniex push ticker, calls onPrice(pair, price) on every last price update
+# and keeps the order books passed in up to date.
+# Runs in a background thread and reconnects with backoff when the socket drops,
+# callers should fall back to polling while live() is false.
+class PriceFeed:
+  def __init__(self, ids, onPrice=None, url=URL, books=None):
+    self.pairs = {int(id):pair for pair, id in ids.items()}
+    self.onPrice = onPrice
+    self.books = books or {}
+    self.url = url
+    self.prices = {}
+    self.connected = False
+    self.lastMessage = 0.0
+    self.stopped = False
+    self.ws = None
+    self.thread = None
+
+  def start(self):
+    self.stopped = False
+    self.thread = threading.Thread(target=self.run, name='pricefeed', daemon=True)
+    self.thread.start()
+    return self
+
+  def stop(self):
+    self.stopped = True
+    if self.ws:
+      self.ws.close()
+
+  def live(self):
+    return self.connected and time.monotonic() - self.lastMessage < STALE
+
+  def run(self):
+    delay = 1
+    while not self.stopped:
+      self.ws = websocket.WebSocketApp(self.url,
+          on_open=self.on_open,
+          on_message=self.on_message,
+          on_error=self.on_error,
+          on_close=self.on_close)
+      self.ws.run_forever()
+      self.connected = False
+      if self.stopped:
+        break
+      if self.lastMessage:
+        delay = 1
+      log.warning(f'Price feed disconnected, reconnecting in {delay} seconds...')
+      time.sleep(delay)
+      delay = min(delay * 2, 60)
+      self.lastMessage = 0.0
+
+  def on_open(self, ws):
+    ws.send(json.dumps({'command':'subscribe', 'channel':TICKER_CHANNEL}))
+    for pair, book in self.books.items():
+      book.reset()
+      ws.send(json.dumps({'command':'subscribe', 'channel':pair}))
+    self.connected = True
+    self.lastMessage = time.monotonic()
+    log.info(f'Connected to price feed {self.url}')
+
+  def on_message(self, ws, message):
+    self.lastMessage = time.monotonic()
+    try:
+      message = json.loads(message)
+      if message[0] in self.pairs and len(message) > 2:
+        self.onBook(ws, self.pairs[message[0]], message[1], message[2])
+        return
+      if message[0] != TICKER_CHANNEL or len(message) < 3:
+        return
+      update = message[2]
+      pair = self.pairs.get(int(update[0]))
+      if not pair:
+        return
+      price = float(update[1])
+    except (ValueError, TypeError, IndexError, KeyError) as err:
+      log.warning(f'Price feed: bad message {message}: {err}')
+      return
+    self.prices[pair] = price
+    if self.onPrice:
+      self.onPrice(pair, price)
+
+  def onBook(self, ws, pair, seq, updates):
+    book = self.books.get(pair)
+    if book and not book.apply(int(seq), updates):
+      ws.send(json.dumps({'command':'unsubscribe', 'channel':pair}))
+      ws.send(json.dumps({'command':'subscribe', 'channel':pair}))
+
+  def on_error(self, ws, error):
+    log.warning(f'Price feed: {error}')
+
+  def on_close(self, ws, *args):
+    self.connected = False
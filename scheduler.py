@@ -0,0 +1,189 @@
+import time
+import heapq
+import functools
+import itertools
+import threading
+from contextlib import contextmanager
+import metrics
+
+# Lanes in priority order, a free token always goes to the highest lane waiting
+LANES = ('orders', 'balances', 'ticker', 'chart', 'reporting')
+PRIORITY = {lane:n for n, lane in enumerate(LANES)}
+
+# Lane and rate limit class of each scheduled Poloniex call
+CALLS = {
+    'buy':('orders', 'private'),
+    'sell':('orders', 'private'),
+    'cancelOrder':('orders', 'private'),
+    'returnBalances':('balances', 'private'),
+    'returnCompleteBalances':('balances', 'private'),
+    'returnTicker':('ticker', 'public'),
+    'returnOrderBook':('ticker', 'public'),
+    'returnChartData':('chart', 'public')
+    }
+
+# Calls without arguments that share one response with an identical call.
+# True when a call already sent can be joined, balances are only shared
+# while waiting so nobody gets balances read before they asked.
+COALESCE = {'returnTicker':True, 'returnBalances':False}
+
+# Calls per second of each class, Poloniex allows 6
+rates = {'public':6, 'private':6}
+
+class TokenBucket:
+  def __init__(self, rate, burst=None):
+    self.rate = rate
+    self.burst = burst or rate
+    self.tokens = self.burst
+    self.time = time.monotonic()
+
+  # Takes a token, or returns the seconds until there is one
+  def take(self):
+    now = time.monotonic()
+    self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+    self.time = now
+    if self.tokens >= 1:
+      self.tokens -= 1
+      return 0
+    return (1 - self.tokens) / self.rate
+
+class Call:
+  def __init__(self, name, lane, group):
+    self.name = name
+    self.lane = lane
+    self.group = group
+    self.entry = None
+    self.sent = False
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+_local = threading.local()
+
+# Calls made inside go to the lane given, e.g. reporting for telegram commands
+@contextmanager
+def lane(name):
+  previous = getattr(_local, 'lane', None)
+  _local.lane = name
+  try:
+    yield
+  finally:
+    _local.lane = previous
+
+# Rate limits Poloniex calls from every thread with a token bucket per call class,
+# queued calls are sent by lane priority, then in order
+class Scheduler:
+  def __init__(self, rates=rates):
+    self.buckets = {group:TokenBucket(rate) for group, rate in rates.items()}
+    self.queues = {group:[] for group in rates}
+    self.depth = {lane:0 for lane in LANES}
+    self.waits = {lane:{'calls':0, 'wait':0.0} for lane in LANES}
+    self.shared = {}
+    self.order = itertools.count()
+    self.cond = threading.Condition()
+
+  def queued(self, lane, change):
+    self.depth[lane] += change
+    metrics.gauge('scheduler_queue_depth', self.depth[lane], lane=lane)
+
+  # Moves a waiting call up to the lane of a caller that joined it
+  def promote(self, call, lane):
+    if call.sent or PRIORITY[lane] >= PRIORITY[call.lane]:
+      return
+    # Not queued yet, it queues in the new lane
+    if call.entry is None:
+      call.lane = lane
+      return
+    queue = self.queues[call.group]
+    index = queue.index(call.entry)
+    call.entry = queue[index] = (PRIORITY[lane], call.entry[1])
+    heapq.heapify(queue)
+    self.queued(call.lane, -1)
+    self.queued(lane, 1)
+    call.lane = lane
+    self.cond.notify_all()
+
+  def wait(self, call):
+    queue = self.queues[call.group]
+    start = time.monotonic()
+    with self.cond:
+      call.entry = (PRIORITY[call.lane], next(self.order))
+      heapq.heappush(queue, call.entry)
+      self.queued(call.lane, 1)
+      while True:
+        if queue[0] == call.entry:
+          delay = self.buckets[call.group].take()
+          if not delay:
+            break
+          self.cond.wait(delay)
+        else:
+          self.cond.wait()
+      heapq.heappop(queue)
+      call.sent = True
+      self.queued(call.lane, -1)
+      waited = time.monotonic() - start
+      self.waits[call.lane]['calls'] += 1
+      self.waits[call.lane]['wait'] += waited
+      self.cond.notify_all()
+    metrics.observe('scheduler_wait_seconds', waited, lane=call.lane)
+
+  def call(self, name, fn, *args, **kwargs):
+    lane, group = CALLS[name]
+    lane = getattr(_local, 'lane', None) or lane
+    key = name if name in COALESCE and not args and not kwargs else None
+    with self.cond:
+      shared = self.shared.get(key)
+      if shared and (COALESCE[name] or not shared.sent):
+        self.promote(shared, lane)
+      else:
+        shared = None
+        call = Call(name, lane, group)
+        if key:
+          self.shared[key] = call
+    if shared:
+      metrics.increment('scheduler_coalesced_total', call=name)
+      shared.done.wait()
+      if shared.error:
+        raise shared.error
+      return shared.result
+    try:
+      self.wait(call)
+      call.result = fn(*args, **kwargs)
+      return call.result
+    except Exception as err:
+      call.error = err
+      raise
+    finally:
+      with self.cond:
+        if key and self.shared.get(key) is call:
+          del self.shared[key]
+      call.done.set()
+
+  # Queue depth, sent calls and mean wait of each lane
+  def stats(self):
+    with self.cond:
+      return {lane:{
+          'queued':self.depth[lane],
+          'calls':self.waits[lane]['calls'],
+          'wait':round(self.waits[lane]['wait'] / self.waits[lane]['calls'], 3) if self.waits[lane]['calls'] else 0.0
+          } for lane in LANES}
+
+def configure(public=None, private=None):
+  if public is not None:
+    rates['public'] = public
+  if private is not None:
+    rates['private'] = private
+
+# Sends the polo calls through a scheduler, the client's own first come first served
+# limiter is turned off as it would undo the lane priorities
+def install(polo, scheduler=None):
+  scheduler = scheduler or Scheduler(rates)
+  polo.coach = False
+  for name in CALLS:
+    method = getattr(polo, name, None)
+    if method is None:
+      continue
+    def scheduled(*args, method=method, name=name, **kwargs):
+      return scheduler.call(name, method, *args, **kwargs)
+    setattr(polo, name, functools.wraps(method)(scheduled))
+  return scheduler
@@ -0,0 +1,80 @@
+import threading
+from urllib.parse import urlsplit
+import metrics
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# One keep-alive session per host so repeated calls reuse their connections
+poolSize = 4
+timeout = 10
+retries = 3
+backoff = 0.5
+_sessions = {}
+_lock = threading.Lock()
+
+def configure(size=None, seconds=None, attempts=None, factor=None):
+  global poolSize, timeout, retries, backoff
+  if size is not None:
+    poolSize = size
+  if seconds is not None:
+    timeout = seconds
+  if attempts is not None:
+    retries = attempts
+  if factor is not None:
+    backoff = factor
+
+# Without attempts the adapter doesn't retry at all, a Retry of 0 would still turn
+# 429 and 5xx answers into RetryError
+def _mount(session, attempts):
+  retry = Retry(total=attempts, backoff_factor=backoff, status_forcelist=(429, 500, 502, 503, 504)) if attempts else 0
+  adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolSize, max_retries=retry)
+  session.mount('https://', adapter)
+  session.mount('http://', adapter)
+
+def session(host):
+  with _lock:
+    if host not in _sessions:
+      _sessions[host] = requests.Session()
+      _mount(_sessions[host], retries)
+    return _sessions[host]
+
+# Timed by host and the last path segment, e.g. sendMessage, which keeps bot tokens out of labels
+def request(method, url, **kwargs):
+  kwargs.setdefault('timeout', timeout)
+  parts = urlsplit(url)
+  with metrics.timer('http_request_seconds', host=parts.netloc, call=parts.path.rsplit('/', 1)[-1]):
+    return session(parts.netloc).request(method, url, **kwargs)
+
+def get(url, **kwargs):
+  return request('GET', url, **kwargs)
+
+def post(url, **kwargs):
+  return request('POST', url, **kwargs)
+
+# Pools the Poloniex client session, it retries on its own so no retries here
+def usePoloniex(polo):
+  if not isinstance(getattr(polo, 'session', None), requests.Session):
+    return
+  _mount(polo.session, 0)
+  if polo.timeout is None:
+    polo.timeout = timeout
+  with _lock:
+    _sessions['poloniex.com'] = polo.session
+
+# Requests sent and connections opened per host, the difference are reused connections
+def connectionStats():
+  stats = {}
+  with _lock:
+    sessions = list(_sessions.items())
+  for host, hostSession in sessions:
+    sent = opened = 0
+    for adapter in set(hostSession.adapters.values()):
+      pools = adapter.poolmanager.pools
+      for key in pools.keys():
+        pool = pools.get(key)
+        if pool:
+          sent += pool.num_requests
+          opened += pool.num_connections
+    stats[host] = {'requests':sent, 'connections':opened, 'reused':max(0, sent - opened)}
+  return stats
@@ -0,0 +1,24 @@
+import os
+import json
+
+# Replaces path in one step so a crash never leaves a half written file
+def writeAtomic(path, text):
+  folder = os.path.dirname(path)
+  if folder:
+    os.makedirs(folder, exist_ok=True)
+  tmp = path + '.tmp'
+  with open(tmp, 'w') as f:
+    f.write(text)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(tmp, path)
+
+def writeJson(path, data):
+  writeAtomic(path, json.dumps(data))
+
+def readJson(path, default=None):
+  try:
+    with open(path) as f:
+      return json.load(f)
+  except (FileNotFoundError, ValueError):
+    return default
@@ -0,0 +1,149 @@
+import logging
+import storage
+
+log = logging.getLogger('main')
+
+# Smallest base balance worth opening a position with
+MIN_BALANCE = 2
+
+# Heikin Ashi color change strategy.
+# Decides on candle closes and price ticks, order execution is left to the caller
+# which reports fills back with opened(), closed() and cancel().
+class Strategy:
+  def __init__(self, pair, maxrisk, maxposition=False, logger=None, statePath=None):
+    self.log = logger or log
+    self.statePath = statePath
+    self.lastCandleDate = 0
+    self.pair = pair
+    self.base, self.coin = pair.split('_')
+    self.maxrisk = maxrisk
+    self.maxposition = maxposition
+    self.position_open = False
+    self.position_size = False
+    self.position_entry = False
+    self.position_stopLoss = False
+    # Coin bought by this position, other periods of the pair share the balance
+    self.position_amount = False
+    # Side of an order sent but not reported back yet, a restart finds out from the balance
+    self.order_pending = False
+    self.expected_risk_persent = False
+    self.expected_risk = False
+
+  # Position state is written on every change so a restart can re-arm it right away
+  def save(self):
+    if not self.statePath:
+      return
+    storage.writeJson(self.statePath, {
+        'position_open':self.position_open,
+        'position_size':self.position_size,
+        'position_entry':self.position_entry,
+        'position_stopLoss':self.position_stopLoss,
+        'position_amount':self.position_amount,
+        'order_pending':self.order_pending,
+        'expected_risk':self.expected_risk,
+        'expected_risk_persent':self.expected_risk_persent,
+        'lastCandleDate':self.lastCandleDate
+        })
+
+  def load(self):
+    state = storage.readJson(self.statePath) if self.statePath else None
+    if not state:
+      return False
+    for key, value in state.items():
+      setattr(self, key, value)
+    self.log.info(f'Restored position, open: {self.position_open}, entry: {self.position_entry}, stop loss: {self.position_stopLoss}, size: {self.position_size}')
+    return True
+
+  def signal(self, last, before):
+    if last.green and not before.green:
+      return 'buy'
+    if not last.green and before.green:
+      return 'pullback'
+    if not last.green and self.position_open:
+      return 'red'
+    return None
+
+  def setup(self, candle, total_balance, available_balance):
+    candle_change = 1 - ( candle.low / candle.high )
+    if candle_change <= 0:
+      self.log.info('Flat candle, no position setup')
+      return False
+    self.position_entry = candle.high
+    self.position_stopLoss = candle.low
+    maxloss = total_balance * self.maxrisk
+    position_size = min(maxloss / candle_change, available_balance)
+    if self.maxposition:
+      position_size = min(position_size, self.maxposition)
+    self.expected_risk = position_size * candle_change
+    self.expected_risk_persent = self.expected_risk / total_balance
+    self.position_size = float(f'{position_size:.8f}')
+    self.log.info(f'Candle risk: {candle_change * 100:.3f}%')
+    self.log.info(f'Available balance: {available_balance} {self.base}')
+    self.log.info(f'Position entry: {self.position_entry}')
+    self.log.info(f'Position stop loss: {self.position_stopLoss}')
+    self.log.info(f'Position size: {self.position_size} {self.base}')
+    self.log.info(f'Expected risk: {self.expected_risk_persent*100:.2f}%, {self.expected_risk:.8f} {self.base}')
+    self.save()
+    return True
+
+  def moveStop(self, candle):
+    self.position_stopLoss = candle.low
+    self.log.info(f'Position stop loss moved to {self.position_stopLoss}')
+    self.save()
+
+  # Stop loss for a balance found on startup, low of the last color change.
+  # An entry left armed is dropped, the balance is the position it bought.
+  def restore(self, chart, amount=False):
+    for n in range(len(chart) - 2, 0, -1):
+      if chart[n].green != chart[n-1].green:
+        self.position_stopLoss = float(chart[n].low)
+        self.log.info(f'Stop loss set to {self.position_stopLoss}')
+        self.position_open = True
+        self.log.debug(f'position_open: {self.position_open}')
+        self.position_entry = False
+        self.position_amount = amount
+        self.order_pending = False
+        self.save()
+        return True
+    return False
+
+  def check(self, price):
+    if self.position_entry and price > self.position_entry:
+      return 'buy'
+    if self.position_open and price < self.position_stopLoss:
+      return 'sell'
+    if self.position_stopLoss and not self.position_open and price < self.position_stopLoss:
+      return 'cancel'
+    return None
+
+  # Saved before an order is sent
+  def ordering(self, side):
+    self.order_pending = side
+    self.save()
+
+  # A buy while a position is open adds to it
+  def opened(self, amount=False):
+    if self.position_open and self.position_amount and amount:
+      amount += self.position_amount
+    self.position_open = True
+    self.position_amount = amount
+    self.log.debug(f'position_open: {self.position_open}')
+    self.position_entry = False
+    self.log.debug('Position entry removed')
+    self.order_pending = False
+    self.save()
+
+  def closed(self):
+    self.position_stopLoss = False
+    self.log.debug('Position stop loss removed')
+    self.position_entry = False
+    self.log.debug('Position entry removed')
+    self.position_open = False
+    self.log.debug(f'Position open: {self.position_open}')
+    self.position_amount = False
+    self.order_pending = False
+    self.save()
+
+  def cancel(self):
+    self.log.info('Entry not hit, position cancelled')
+    self.closed()
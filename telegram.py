@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import logging
+import threading
+import engine
+import sessions
+import storage
+from outbox import RetryAfter, Rejected
+
+log = logging.getLogger('main')
+reqlog = logging.getLogger('urllib3')
+
+URL = 'https://api.telegram.org'
+
+def readOffset(path):
+  try:
+    with open(path) as f:
+      return int(f.read().strip() or 0)
+  except (FileNotFoundError, ValueError):
+    return 0
+
+def writeOffset(path, offset):
+  storage.writeAtomic(path, str(offset))
+
+# Deliver function for an outbox of Telegram messages, the text goes in a json body
+def sender(token, url=URL):
+  def sendMessage(chatid, text):
+    response = sessions.post(f'{url}/bot{token}/sendMessage', json={'chat_id':chatid, 'text':text})
+    try:
+      result = response.json()
+    except ValueError:
+      result = {}
+    if result.get('ok'):
+      return
+    description = result.get('description', response.status_code)
+    if response.status_code == 429:
+      raise RetryAfter(result.get('parameters', {}).get('retry_after', 1))
+    if 400 <= response.status_code < 500:
+      raise Rejected(description)
+    raise IOError(description)
+  return sendMessage
+
+# Telegram bot commands with long polling in a background thread.
+# The update offset is kept on disk so commands are not handled twice after a restart,
+# handlers run on the io lane so a slow command doesn't hold up polling.
+class CommandService:
+  def __init__(self, token, userid, handlers, offsetPath=os.path.join('data', 'telegram-offset'), timeout=50, url=URL):
+    self.token = token
+    self.userid = int(userid)
+    self.handlers = handlers
+    self.offsetPath = offsetPath
+    self.offset = readOffset(offsetPath)
+    self.timeout = timeout
+    self.url = url
+    self.stopped = False
+    self.thread = None
+
+  def start(self):
+    self.thread = threading.Thread(target=self.run, name='telegram', daemon=True)
+    self.thread.start()
+    log.info(f'Telegram commands started, update offset: {self.offset}')
+    return self
+
+  def stop(self):
+    self.stopped = True
+
+  def getUpdates(self):
+    params = {
+        'offset':self.offset,
+        'timeout':self.timeout,
+        'allowed_updates':json.dumps(['message'])
+        }
+    response = sessions.get(f'{self.url}/bot{self.token}/getUpdates', params=params, timeout=self.timeout + 10)
+    return response.json()
+
+  def run(self):
+    delay = 1
+    while not self.stopped:
+      try:
+        updates = self.getUpdates()
+        reqlog.debug(updates)
+        if not updates.get('ok'):
+          raise ValueError(updates.get('description', updates))
+        self.handle(updates['result'])
+        delay = 1
+      except Exception as err:
+        log.warning(f'Telegram getUpdates failed: {err!r}, retrying in {delay} seconds...')
+        time.sleep(delay)
+        delay = min(delay * 2, 60)
+
+  def handle(self, updates):
+    if not updates:
+      return
+    self.offset = updates[-1]['update_id'] + 1
+    writeOffset(self.offsetPath, self.offset)
+    for update in updates:
+      message = update.get('message')
+      if not message or 'text' not in message:
+        continue
+      chatid = message['chat']['id']
+      log.debug(f'Received from chat_id {chatid}:\n{message["text"]}')
+      if chatid != self.userid:
+        continue
+      handler = self.handlers.get(message['text'].split()[0])
+      if handler:
+        engine.background(handler)
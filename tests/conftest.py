@@ -0,0 +1,15 @@
+import os
+import sys
+import time
+
+# Modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Polls until condition() is true, False after timeout seconds
+def waitFor(condition, timeout=5):
+  end = time.monotonic() + timeout
+  while time.monotonic() < end:
+    if condition():
+      return True
+    time.sleep(0.02)
+  return condition()
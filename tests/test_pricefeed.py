@@ -0,0 +1,180 @@
+import json
+import asyncio
+import threading
+import pytest
+import websockets
+import api
+import main
+import pricefeed
+from conftest import waitFor
+
+BTC = 121
+
+def tickerMessage(price, id=BTC):
+  return json.dumps([pricefeed.TICKER_CHANNEL, None, [id, str(price), '0', '0', '0', '0', '0', '0', '0', '0']])
+
+# Local push api, each connection runs the next script, the last one for the rest
+class FakePushApi:
+  def __init__(self, scripts):
+    self.scripts = scripts
+    self.connections = 0
+    self.subscriptions = []
+    self.loop = asyncio.new_event_loop()
+    self.ready = threading.Event()
+    self.thread = threading.Thread(target=self.loop.run_until_complete, args=(self.serve(),), daemon=True)
+    self.thread.start()
+    assert self.ready.wait(5)
+
+  async def serve(self):
+    self.done = asyncio.Event()
+    async with websockets.serve(self.handler, '127.0.0.1', 0, close_timeout=0.5) as server:
+      self.url = f'ws://127.0.0.1:{server.sockets[0].getsockname()[1]}'
+      self.ready.set()
+      await self.done.wait()
+
+  async def handler(self, ws):
+    script = self.scripts[min(self.connections, len(self.scripts) - 1)]
+    self.connections += 1
+    self.subscriptions.append(json.loads(await ws.recv()))
+    await script(ws)
+
+  def close(self):
+    self.loop.call_soon_threadsafe(self.done.set)
+    self.thread.join(5)
+
+@pytest.fixture
+def pushApi():
+  servers = []
+  def start(*scripts):
+    servers.append(FakePushApi(scripts))
+    return servers[-1]
+  yield start
+  for server in servers:
+    server.close()
+
+@pytest.fixture
+def feeds():
+  started = []
+  def start(url, onPrice=None):
+    started.append(pricefeed.PriceFeed({'USDT_BTC':BTC}, onPrice, url).start())
+    return started[-1]
+  yield start
+  for feed in started:
+    feed.stop()
+
+async def hold(ws):
+  await ws.wait_closed()
+
+def test_prices_reach_onPrice(pushApi, feeds):
+  async def script(ws):
+    await ws.send(tickerMessage(9000.5))
+    await ws.send(tickerMessage(1.0, id=999))
+    await hold(ws)
+  server = pushApi(script)
+  prices = []
+  feed = feeds(server.url, lambda pair, price: prices.append((pair, price)))
+  assert waitFor(lambda: prices)
+  assert server.subscriptions == [{'command':'subscribe', 'channel':pricefeed.TICKER_CHANNEL}]
+  assert prices == [('USDT_BTC', 9000.5)]
+  assert feed.prices == {'USDT_BTC':9000.5}
+  assert feed.live()
+
+def test_reconnects_after_the_server_drops(pushApi, feeds):
+  async def drop(ws):
+    await ws.send(tickerMessage(100))
+    await ws.close()
+  async def stay(ws):
+    await ws.send(tickerMessage(101))
+    await hold(ws)
+  server = pushApi(drop, stay)
+  prices = []
+  feed = feeds(server.url, lambda pair, price: prices.append(price))
+  assert waitFor(lambda: 101 in prices, timeout=10)
+  assert prices == [100, 101]
+  assert server.connections == 2
+  assert len(server.subscriptions) == 2
+  assert feed.live()
+
+def test_not_live_while_disconnected(pushApi, feeds):
+  async def drop(ws):
+    await ws.send(tickerMessage(100))
+    await ws.close()
+  server = pushApi(drop)
+  prices = []
+  feed = feeds(server.url, lambda pair, price: prices.append(price))
+  assert waitFor(lambda: prices)
+  assert waitFor(lambda: not feed.connected)
+  assert not feed.live()
+
+def test_not_live_while_silent(pushApi, feeds, monkeypatch):
+  monkeypatch.setattr(pricefeed, 'STALE', 0.3)
+  resume = threading.Event()
+  async def silent(ws):
+    await ws.send(tickerMessage(100))
+    await asyncio.get_running_loop().run_in_executor(None, resume.wait, 5)
+    await ws.send(json.dumps([pricefeed.HEARTBEAT_CHANNEL]))
+    await hold(ws)
+  server = pushApi(silent)
+  feed = feeds(server.url)
+  assert waitFor(feed.live)
+  assert waitFor(lambda: not feed.live())
+  assert feed.connected
+  resume.set()
+  assert waitFor(feed.live)
+
+class FakeFeed:
+  def __init__(self, live):
+    self.isLive = live
+
+  def live(self):
+    return self.isLive
+
+class FakePoloniex:
+  def __init__(self):
+    self.tickers = 0
+
+  def returnTicker(self):
+    self.tickers += 1
+    return {'USDT_BTC':{'last':'100.5', 'id':BTC}}
+
+class FakeTrader:
+  pair = 'USDT_BTC'
+
+  def __init__(self):
+    self.prices = []
+
+  def onPrice(self, price, now=None):
+    self.prices.append(price)
+
+def runTickLoop(feed, seconds=0.3):
+  trader = FakeTrader()
+  async def run():
+    try:
+      await asyncio.wait_for(main.tickLoop([trader], feed), seconds)
+    except asyncio.TimeoutError:
+      pass
+  asyncio.run(run())
+  return trader
+
+@pytest.fixture
+def polling(monkeypatch):
+  polo = FakePoloniex()
+  monkeypatch.setattr(main, 'polo', polo)
+  monkeypatch.setattr(main, 'tick', 0.05)
+  monkeypatch.setattr(api, 'tickerTtl', 0)
+  return polo
+
+def test_tick_loop_polls_while_the_feed_is_down(polling):
+  trader = runTickLoop(FakeFeed(False))
+  assert polling.tickers >= 2
+  assert trader.prices and set(trader.prices) == {100.5}
+
+def test_tick_loop_leaves_prices_to_a_live_feed(polling):
+  trader = runTickLoop(FakeFeed(True))
+  assert polling.tickers == 0
+  assert trader.prices == []
+
+def test_tick_loop_polls_without_a_feed(polling):
+  trader = runTickLoop(None)
+  assert polling.tickers >= 2
+  assert trader.prices
@@ -0,0 +1,163 @@
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+import pytest
+import telegram
+from outbox import RetryAfter, Rejected
+from conftest import waitFor
+
+TOKEN = '123:abc'
+USER = 42
+
+def message(id, text, chat=USER):
+  return {'update_id':id, 'message':{'message_id':id, 'chat':{'id':chat}, 'text':text}}
+
+class BotApiHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    api = self.server.api
+    parts = urlsplit(self.path)
+    assert parts.path == f'/bot{TOKEN}/getUpdates'
+    params = {name:values[0] for name, values in parse_qs(parts.query).items()}
+    api.polls.append(params)
+    if api.pollReplies:
+      self.reply(*api.pollReplies.pop(0))
+      return
+    self.reply(200, {'ok':True, 'result':api.waitUpdates(int(params['offset']), float(params['timeout']))})
+
+  def do_POST(self):
+    api = self.server.api
+    body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+    api.sent.append((urlsplit(self.path).path, body))
+    self.reply(*(api.replies.pop(0) if api.replies else (200, {'ok':True, 'result':{}})))
+
+  def reply(self, status, data):
+    body = json.dumps(data).encode()
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+# Local Bot API, getUpdates holds the request until an update at or after offset
+# arrives or its timeout runs out, like Telegram's long polling
+class FakeBotApi:
+  def __init__(self):
+    self.updates = []
+    self.polls = []
+    self.sent = []
+    self.replies = []
+    self.pollReplies = []
+    self.changed = threading.Condition()
+    self.server = ThreadingHTTPServer(('127.0.0.1', 0), BotApiHandler)
+    self.server.daemon_threads = True
+    self.server.api = self
+    self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+  def push(self, *updates):
+    with self.changed:
+      self.updates.extend(updates)
+      self.changed.notify_all()
+
+  def waitUpdates(self, offset, timeout):
+    with self.changed:
+      self.changed.wait_for(lambda: any(update['update_id'] >= offset for update in self.updates), timeout)
+      return [update for update in self.updates if update['update_id'] >= offset]
+
+  def close(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+@pytest.fixture
+def botApi():
+  api = FakeBotApi()
+  yield api
+  api.close()
+
+@pytest.fixture
+def services(botApi, tmp_path):
+  started = []
+  def start(handlers, timeout=1):
+    service = telegram.CommandService(TOKEN, USER, handlers, str(tmp_path / 'telegram-offset'), timeout, botApi.url)
+    started.append(service.start())
+    return service
+  yield start
+  for service in started:
+    service.stop()
+  for service in started:
+    service.thread.join(5)
+
+def handlers(calls, *names):
+  return {name:lambda name=name: calls.append(name) for name in names}
+
+def test_commands_from_the_user_run_their_handler(botApi, services, tmp_path):
+  botApi.push(message(10, '/balance'), message(11, '/balance', chat=7),
+    {'update_id':12, 'edited_message':{}}, message(13, '/journal now'), message(14, '/unknown'))
+  calls = []
+  service = services(handlers(calls, '/balance', '/journal'))
+  assert waitFor(lambda: len(calls) == 2)
+  assert sorted(calls) == ['/balance', '/journal']
+  assert waitFor(lambda: service.offset == 15)
+  assert telegram.readOffset(str(tmp_path / 'telegram-offset')) == 15
+
+def test_long_poll_returns_when_an_update_arrives(botApi, services):
+  calls = []
+  services(handlers(calls, '/balance'), timeout=3)
+  assert waitFor(lambda: botApi.polls)
+  assert botApi.polls[0]['offset'] == '0'
+  assert botApi.polls[0]['timeout'] == '3'
+  assert json.loads(botApi.polls[0]['allowed_updates']) == ['message']
+  botApi.push(message(20, '/balance'))
+  # Well inside the 3 second poll, the held request answers as soon as the update is there
+  assert waitFor(lambda: calls, timeout=1.5)
+  assert waitFor(lambda: len(botApi.polls) >= 2)
+  assert botApi.polls[1]['offset'] == '21'
+
+def test_offset_survives_a_restart(botApi, services, tmp_path):
+  botApi.push(message(30, '/balance'), message(31, '/balance'))
+  calls = []
+  first = services(handlers(calls, '/balance'))
+  assert waitFor(lambda: len(calls) == 2)
+  first.stop()
+  first.thread.join(5)
+  assert telegram.readOffset(str(tmp_path / 'telegram-offset')) == 32
+  polls = len(botApi.polls)
+  second = services(handlers(calls, '/balance'))
+  assert second.offset == 32
+  botApi.push(message(32, '/balance'))
+  assert waitFor(lambda: len(calls) == 3)
+  assert botApi.polls[polls]['offset'] == '32'
+
+def test_failed_polls_are_retried(botApi, services):
+  calls = []
+  botApi.push(message(40, '/balance'))
+  botApi.pollReplies = [(200, {'ok':False, 'description':'Conflict: terminated by other getUpdates request'})]
+  services(handlers(calls, '/balance'))
+  assert waitFor(lambda: calls, timeout=5)
+  assert [poll['offset'] for poll in botApi.polls[:2]] == ['0', '0']
+
+def test_sender_posts_json(botApi):
+  send = telegram.sender(TOKEN, botApi.url)
+  send(USER, 'Entry price hit\n"USDT_BTC" Buy & more')
+  assert botApi.sent == [(f'/bot{TOKEN}/sendMessage', {'chat_id':USER, 'text':'Entry price hit\n"USDT_BTC" Buy & more'})]
+
+def test_sender_errors(botApi):
+  send = telegram.sender(TOKEN, botApi.url)
+  botApi.replies = [
+      (429, {'ok':False, 'description':'Too Many Requests', 'parameters':{'retry_after':7}}),
+      (400, {'ok':False, 'description':'Bad Request: chat not found'}),
+      (502, {'ok':False, 'description':'Bad Gateway'})
+      ]
+  with pytest.raises(RetryAfter) as err:
+    send(USER, 'one')
+  assert err.value.seconds == 7
+  with pytest.raises(Rejected, match='chat not found'):
+    send(USER, 'two')
+  with pytest.raises(IOError, match='Bad Gateway'):
+    send(USER, 'three')